@@ -0,0 +1,291 @@
+# async_engine.py
+import asyncio
+import os
+import time
+
+from openai import AsyncOpenAI, AsyncAssistantEventHandler
+import openai
+from typing_extensions import override
+
+from engine import TrainingAgent
+from controller import ActionHandle, LeverPress
+from dispatch import AsyncToolDispatcher
+from replay import async_http_client
+
+
+class AsyncTrainingAgent(TrainingAgent):
+
+    # Runs the stream, the tools, operator messages and lever events as tasks on one
+    # event loop. An interrupt cancels the task consuming the run, which also cancels
+    # the tool calls it is awaiting. Setup, compaction, reasoning and human help still
+    # use the blocking client off the hot path.
+
+    # Tools that use the cage hardware. A blocking one cancelled by an interrupt keeps
+    # running in its thread, and these do not start until it has finished
+    HARDWARE_TOOLS = ("feed", "play_sound", "play_pattern", "wait_for_lever", "run_trials")
+
+    class EventHandler(AsyncAssistantEventHandler):
+        def __init__(self, agent):
+            super().__init__()
+            self.agent = agent
+
+        @override
+        async def on_event(self, event):
+            self.agent._first_token(event)
+            self.agent._log({"status": str(event.event)})
+            if event.event == 'thread.run.requires_action':
+                await self.handle_requires_action(event.data, event.data.id)
+
+        @override
+        async def on_message_done(self, message):
+            if self.agent.message_cursor.observe(message):
+                self.agent._log({"messages": str(message.content)})
+                self.agent.compactor.observe(str(message.content))
+
+        async def handle_requires_action(self, data, run_id):
+            tool_calls = data.required_action.submit_tool_outputs.tool_calls
+            for tool in tool_calls:
+                self.agent._log({"tool_calls": str(tool)})
+            outputs = await self.agent.dispatcher.dispatch(
+                [(tool.function.name, tool.function.arguments) for tool in tool_calls],
+                deadline=self.agent.lifecycle.deadline(data),
+            )
+            tool_outputs = [
+                {"tool_call_id": tool.id, "output": output}
+                for tool, output in zip(tool_calls, outputs)
+            ]
+            for tool, output in zip(tool_calls, outputs):
+                self.agent.compactor.observe_tool_result(tool.function.name, tool.function.arguments, output)
+
+            self.agent._log({"tool_outputs": str(tool_outputs)})
+            await self.submit_tool_outputs(tool_outputs, run_id, tool_calls)
+
+        async def submit_tool_outputs(self, tool_outputs, run_id, tool_calls):
+            client = self.agent.aclient
+            run = await client.beta.threads.runs.retrieve(
+                thread_id=self.current_run.thread_id,
+                run_id=self.current_run.id
+            )
+            if run.status != 'requires_action':
+                print(f"run {run.status}! keeping {len(tool_outputs)} tool outputs for the next run")
+                self.agent._log({"run_lost": run.status, "tool_outputs": str(tool_outputs)})
+                self.agent._run_lost(run.status)
+                self.agent.lifecycle.keep(tool_calls, [output["output"] for output in tool_outputs])
+                return
+            try:
+                async with client.beta.threads.runs.submit_tool_outputs_stream(
+                    thread_id=self.current_run.thread_id,
+                    run_id=self.current_run.id,
+                    tool_outputs=tool_outputs,
+                    event_handler=type(self)(self.agent),
+                ) as stream:
+                    await stream.until_done()
+            except openai.BadRequestError as e:
+                print(f"Error submitting tool outputs: {e}")
+                self.agent._run_lost("rejected")
+                self.agent.lifecycle.keep(tool_calls, [output["output"] for output in tool_outputs])
+
+    def __init__(self, *args, aclient: AsyncOpenAI = None, **kwargs):
+        self.loop = None # set by start(); interrupts can arrive during the setup below
+        self._interrupted = None
+        self._tasks = []
+        self._orphans = set() # threads of cancelled hardware tools that are still running
+        super().__init__(*args, **kwargs)
+        self.aclient = aclient or AsyncOpenAI(http_client=async_http_client())
+        self.dispatcher.shutdown()
+        self.dispatcher = AsyncToolDispatcher(
+            {
+                "feed": self.feed,
+                "play_sound": self.play_sound,
+                "wait_for_lever": self.wait_for_lever,
+                "delay": self.delay,
+                **{
+                    name: self._in_thread(name, fn)
+                    for name, fn in self.function_call_switch.items()
+                    if name not in ("feed", "play_sound", "wait_for_lever", "delay")
+                },
+            },
+            self.lifecycle,
+            labels=self.labels,
+        )
+
+    def _start_watchers(self):
+        # Started on the event loop by start()
+        pass
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._interrupted = asyncio.Event()
+        with self._interrupt_lock:
+            self._refresh_interrupt()
+        fd = self._open_pipe()
+        buffer = [b""]
+        def readable():
+            buffer[0] = self._read_pipe(fd, buffer[0])
+        self.loop.add_reader(fd, readable)
+        self._tasks.append(asyncio.ensure_future(self._watch_lever_events()))
+
+    async def _watch_lever_events(self):
+        signal = asyncio.Event()
+        ring = self.controller.lever_events
+        ring.add_listener(lambda: self.loop.call_soon_threadsafe(signal.set))
+        cursor = 0
+        while True:
+            await signal.wait()
+            signal.clear()
+            events, cursor, lost = ring.read(cursor)
+            self._lever_events(events, lost)
+
+    def _refresh_interrupt(self):
+        super()._refresh_interrupt()
+        # Help desk answers and reasoning results arrive on other threads
+        if self.interrupt_pipe_data and self.loop:
+            self.loop.call_soon_threadsafe(self._interrupted.set)
+
+    def _take_interrupts(self) -> str:
+        self._interrupted.clear()
+        return super()._take_interrupts()
+
+    # Tools
+
+    def _in_thread(self, name: str, fn):
+        async def call(**kwargs):
+            if name in self.HARDWARE_TOOLS:
+                await self._hardware_free()
+            future = asyncio.ensure_future(asyncio.to_thread(fn, **kwargs))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Cancelling the task does not stop the thread
+                if name in self.HARDWARE_TOOLS:
+                    self._orphans.add(future)
+                    future.add_done_callback(self._orphan_done)
+                raise
+        return call
+
+    def _orphan_done(self, future: asyncio.Future):
+        self._orphans.discard(future)
+        if not future.cancelled() and future.exception():
+            print(f"Error in cancelled tool: {future.exception()}")
+
+    async def _hardware_free(self):
+        # e.g. a run_trials block from a run that was interrupted
+        if self._orphans:
+            await asyncio.wait(list(self._orphans))
+
+    def _wrap(self, handle: ActionHandle) -> asyncio.Future:
+        future = self.loop.create_future()
+        def done(h):
+            self.loop.call_soon_threadsafe(lambda: future.done() or future.set_result(h.result))
+        handle.add_done_callback(done)
+        return future
+
+    async def delay(self, duration: int) -> bool:
+        await asyncio.sleep(self.clock.timeout(duration))
+        return True
+
+    async def feed(self, duration: int) -> bool:
+        # An interrupted feed still finishes on the scheduler, so the water always goes back up
+        await self._hardware_free()
+        handle = self.controller.start_feed(duration)
+        return bool(await asyncio.shield(self._wrap(handle)))
+
+    async def play_sound(self, duration: int, frequency: int) -> bool:
+        if frequency < self.controller.MIN_FREQ or frequency > self.controller.MAX_FREQ:
+            return False
+        await self._hardware_free()
+        handle = self.controller.start_sound(duration, frequency)
+        return bool(await self._wrap(handle))
+
+    async def wait_for_lever(self, duration: int) -> LeverPress:
+        await self._hardware_free()
+        self.controller.begin_wait()
+        handle = self.controller.next_press()
+        try:
+            press = await asyncio.wait_for(self._wrap(handle), self.clock.timeout(duration))
+        except asyncio.TimeoutError:
+            return LeverPress(-1) # neither lever
+        finally:
+            handle.cancel()
+            self.controller.end_wait()
+        self.controller.lever_latency.observe(self.clock.monotonic() - press.monotonic)
+        return press
+
+    # Runs
+
+    async def train(self):
+        if self.compactor.needs_compaction():
+            await asyncio.to_thread(self._compact_thread)
+        self.session.set_thread_size(self.compactor.messages, self.compactor.chars)
+        content = self._next_message()
+        if content:
+            await self.aclient.beta.threads.messages.create(
+                thread_id=self.thread.id,
+                role="user",
+                content=content
+            )
+            self.compactor.observe(content)
+        handler = self.EventHandler(self)
+        self.runs_started.inc()
+        self._run_started = time.monotonic()
+        run_task = asyncio.ensure_future(self._stream(handler))
+        interrupt_task = asyncio.ensure_future(self._interrupted.wait())
+        await asyncio.wait([run_task, interrupt_task], return_when=asyncio.FIRST_COMPLETED)
+        interrupt_task.cancel()
+        if not run_task.done():
+            run_task.cancel()
+        try:
+            await run_task
+        except asyncio.CancelledError:
+            self.logger.info("run interrupted")
+        if handler.current_run:
+            await asyncio.to_thread(self._catch_up, handler.current_run)
+
+    async def _stream(self, handler):
+        async with self.aclient.beta.threads.runs.stream(
+            thread_id=self.thread.id,
+            assistant_id=self.assistant.id,
+            event_handler=handler,
+        ) as stream:
+            await stream.until_done()
+
+    async def reset(self):
+        runs = await self.aclient.beta.threads.runs.list(
+            thread_id=self.thread.id
+        )
+        active = [run for run in runs.data if run.status in self.ACTIVE_RUN_STATUSES]
+        await asyncio.gather(*[self._cancel_run(run) for run in active])
+
+    async def _cancel_run(self, run):
+        if run.status != "cancelling":
+            try:
+                await self.aclient.beta.threads.runs.cancel(
+                    thread_id=self.thread.id,
+                    run_id=run.id
+                )
+            except Exception as e:
+                print(f"Error cancelling run: {e}")
+        interval = 0.05
+        while True:
+            try:
+                check = await self.aclient.beta.threads.runs.retrieve(
+                    thread_id=self.thread.id,
+                    run_id=run.id
+                )
+            except Exception as e:
+                print(f"Error checking run: {e}")
+                return
+            if check.status not in self.ACTIVE_RUN_STATUSES:
+                return
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, 1)
+
+    def cleanup(self):
+        if self.loop:
+            self.loop.remove_reader(self._pipe_fd)
+        for task in self._tasks:
+            task.cancel()
+        super().cleanup()
+        if self._pipe_fd is not None:
+            os.close(self._pipe_fd) # no reader thread to close it
+            self._pipe_fd = None
@@ -0,0 +1,312 @@
+# bench.py
+import argparse
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from clock import Clock
+from simulation import SimulatedGPIO, SimulatedFeeder
+
+
+# Benchmarks of the controller and engine hot paths on simulated hardware, with the
+# Assistants API replaced by replay.StubServer. Nothing here touches a real cage or
+# the network.
+#
+#   python bench.py                       # run everything, compare with bench_baseline.json
+#   python bench.py --save-baseline       # make this run the new baseline
+#   python bench.py --quick --only lever_latency dispatch
+#
+# Results go to --output as JSON. Metrics ending in _per_s are better when higher,
+# everything else is a time and better when lower. A metric more than TOLERANCE
+# worse than its baseline is a regression and the exit status is 1.
+
+TOLERANCE = 0.2
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _latency(values: list) -> dict:
+    # Seconds in, milliseconds out
+    return {
+        "mean_ms": sum(values) / len(values) * 1000,
+        "p50_ms": _percentile(values, 0.5) * 1000,
+        "p99_ms": _percentile(values, 0.99) * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+def _wait_until(condition, timeout: float = 10):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise TimeoutError("benchmark timed out")
+        time.sleep(0.0005)
+
+
+class SimCage:
+
+    # A MainController on its own simulated GPIO, real-time clock and scratch directory
+
+    def __init__(self):
+        from controller import MainController
+        self.dir = tempfile.TemporaryDirectory(prefix="biotica-bench-")
+        self.gpio = SimulatedGPIO(Clock())
+        self.controller = MainController(gpio=self.gpio, clock=Clock(), data_dir=self.dir.name)
+        feeder = self.controller.feeder
+        self.feeder = SimulatedFeeder(self.gpio, feeder.PINS, feeder.SWITCH_PIN, travel=feeder.LIFT_PHASES)
+        self.pins = [self.controller.LEFT_LEVER_SWITCH, self.controller.RIGHT_LEVER_SWITCH]
+
+    def close(self):
+        self.controller.cleanup()
+        self.dir.cleanup()
+
+
+def bench_lever_latency(quick: bool) -> dict:
+    # Lever edge to wait_for_lever returning, through the GPIO callback thread
+    cage = SimCage()
+    debounce = max(lever.debounce for lever in cage.controller.levers)
+    latencies = []
+    try:
+        for i in range(50 if quick else 300):
+            pin = cage.pins[i % 2]
+            done = {}
+            def wait():
+                cage.controller.wait_for_lever(10)
+                done["at"] = time.monotonic()
+            waiter = threading.Thread(target=wait)
+            waiter.start()
+            _wait_until(lambda: cage.controller.waiting)
+            time.sleep(0.002) # let it reach the condition wait
+            start = time.monotonic()
+            cage.gpio.set_input(pin, cage.gpio.LOW)
+            waiter.join()
+            latencies.append(done["at"] - start)
+            cage.gpio.set_input(pin, cage.gpio.HIGH)
+            time.sleep(debounce * 2)
+    finally:
+        cage.close()
+    return _latency(latencies)
+
+
+def bench_gpio_burst(quick: bool) -> dict:
+    # Edge callbacks per second when presses arrive faster than they can be handled.
+    # Debouncing is off so that every edge is a press or a release
+    cage = SimCage()
+    presses = 500 if quick else 5000
+    recorded = [0]
+    cage.controller.lever_events.add_listener(lambda: recorded.__setitem__(0, recorded[0] + 1))
+    for lever in cage.controller.levers:
+        lever.debounce = 0
+    try:
+        start = time.monotonic()
+        for i in range(presses):
+            pin = cage.pins[i % 2]
+            cage.gpio.set_input(pin, cage.gpio.LOW)
+            cage.gpio.set_input(pin, cage.gpio.HIGH)
+        _wait_until(lambda: recorded[0] >= presses, timeout=60)
+        _wait_until(lambda: cage.gpio._callbacks.empty(), timeout=60)
+        elapsed = time.monotonic() - start
+    finally:
+        cage.close()
+    return {"edges_per_s": 2 * presses / elapsed, "presses_per_s": presses / elapsed}
+
+
+def bench_feeder_cycle(quick: bool) -> dict:
+    # Lower, drink for 0 seconds and lift again, in real time
+    cage = SimCage()
+    cycles = []
+    try:
+        for _ in range(1 if quick else 3):
+            start = time.monotonic()
+            if not cage.controller.feed(0):
+                raise RuntimeError("simulated feed failed")
+            cycles.append(time.monotonic() - start)
+    finally:
+        cage.close()
+    return {"cycle_s": sum(cycles) / len(cycles), "max_cycle_s": max(cycles)}
+
+
+def bench_dispatch(quick: bool) -> dict:
+    # ToolDispatcher overhead for a typical batch of calls that do no work themselves
+    from dispatch import ToolDispatcher
+    from lifecycle import RunLifecycle
+    functions = {name: (lambda **kwargs: True) for name in ToolDispatcher.DEVICES}
+    dispatcher = ToolDispatcher(functions, RunLifecycle(Clock()))
+    batch = [
+        ("play_sound", '{"duration": 1, "frequency": 4000}'),
+        ("wait_for_lever", '{"duration": 10}'),
+        ("feed", '{"duration": 3}'),
+        ("get_stats", '{}'),
+    ]
+    deadline = time.monotonic() + 600
+    latencies = []
+    try:
+        for _ in range(500 if quick else 5000):
+            start = time.monotonic()
+            dispatcher.dispatch(batch, deadline)
+            latencies.append(time.monotonic() - start)
+    finally:
+        dispatcher.shutdown()
+    return _latency(latencies)
+
+
+class _LogEndpoint:
+
+    # Accepts log batches like the real LOG_URL endpoint and counts them
+
+    def __init__(self):
+        endpoint = self
+        self.received = 0
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                endpoint.received += len(json.loads(body))
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            def log_message(self, format, *args):
+                pass
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _agent(stub_url: str, data_dir: str, log_sink=None):
+    from openai import OpenAI
+    from engine import TrainingAgent
+    client = OpenAI(base_url=stub_url, api_key="stub", max_retries=0)
+    return TrainingAgent(client=client, name="bench", data_dir=data_dir, log_sink=log_sink)
+
+
+def bench_engine_turn(quick: bool) -> dict:
+    # A scripted session through the real EventHandler: each turn is a streamed
+    # requires_action, dispatch of two cheap tools, the run check and the submit
+    from replay import StubServer, script
+    runs, turns = (5, 5) if quick else (20, 10)
+    session = [
+        [[["get_stats", {}], ["delay", {"duration": 0}]] for _ in range(turns)] + ["Done."]
+        for _ in range(runs)
+    ]
+    stub = StubServer(script(session))
+    with tempfile.TemporaryDirectory(prefix="biotica-bench-") as data_dir:
+        agent = _agent(stub.base_url, data_dir)
+        try:
+            start = time.monotonic()
+            while not stub.done.is_set():
+                agent.train()
+                agent.reset()
+            elapsed = time.monotonic() - start
+        finally:
+            agent.cleanup()
+            stub.close()
+    return {"turn_ms": elapsed / (runs * turns) * 1000, "run_ms": elapsed / runs * 1000}
+
+
+def bench_log(quick: bool) -> dict:
+    # TrainingAgent._log calls per second, and how fast the sink delivers them
+    from replay import StubServer, script
+    from telemetry import LogSink
+    events = 2000 if quick else 20000
+    stub = StubServer(script([]))
+    endpoint = _LogEndpoint()
+    with tempfile.TemporaryDirectory(prefix="biotica-bench-") as data_dir:
+        sink = LogSink(endpoint.url, "bench", os.path.join(data_dir, "log_spool"))
+        agent = _agent(stub.base_url, data_dir, log_sink=sink)
+        try:
+            start = time.monotonic()
+            for i in range(events):
+                agent._log({"tool_outputs": f"[{{'tool_call_id': 'call_{i}', 'output': 'True'}}]"})
+            logged = time.monotonic() - start
+            _wait_until(lambda: endpoint.received >= events, timeout=120)
+            delivered = time.monotonic() - start
+        finally:
+            agent.cleanup()
+            sink.close()
+            endpoint.close()
+            stub.close()
+    return {"calls_per_s": events / logged, "delivered_per_s": events / delivered}
+
+
+BENCHMARKS = {
+    "lever_latency": bench_lever_latency,
+    "gpio_burst": bench_gpio_burst,
+    "feeder_cycle": bench_feeder_cycle,
+    "dispatch": bench_dispatch,
+    "engine_turn": bench_engine_turn,
+    "log": bench_log,
+}
+
+
+def compare(results: dict, baseline: dict) -> list:
+    # Returns (benchmark, metric, baseline, result, change, regressed) for every shared metric
+    rows = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            change = (value - old) / old
+            worse = -change if metric.endswith("_per_s") else change
+            rows.append((name, metric, old, value, change, worse > TOLERANCE))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the controller and engine on simulated hardware")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for a smoke test")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to the baseline file too")
+    args = parser.parse_args()
+
+    os.environ["BIOTICA_HARDWARE"] = "sim" # never drive a real cage from here
+    os.environ.setdefault("BIOTICA_METRICS_PORT", "0")
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"{name}...", flush=True)
+        results[name] = BENCHMARKS[name](args.quick)
+        print("    " + ", ".join(f"{metric} {value:.3f}" for metric, value in results[name].items()))
+
+    report = {
+        "at": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "quick": args.quick,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; run with --save-baseline to create one")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline["results"])
+    for name, metric, old, value, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:>14} {metric:<18} {old:12.3f} -> {value:12.3f} ({change:+.0%}){flag}")
+    if any(row[-1] for row in rows):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# clock.py
+import os
+import time
+
+_clock = None
+
+
+class Clock:
+
+    # Real time; WarpClock runs the same interface faster than real time
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        time.sleep(max(0, seconds))
+
+    def timeout(self, seconds: float) -> float:
+        # Converts a duration on this clock into a real timeout for Event/Condition waits
+        return seconds
+
+
+class WarpClock(Clock):
+
+    def __init__(self, factor: float):
+        # Every real second advances the clock by `factor` seconds
+        self.factor = factor
+        self._real_start = time.monotonic()
+        self._wall_start = time.time()
+
+    def _elapsed(self) -> float:
+        return (time.monotonic() - self._real_start) * self.factor
+
+    def time(self) -> float:
+        return self._wall_start + self._elapsed()
+
+    def monotonic(self) -> float:
+        return self._real_start + self._elapsed()
+
+    def sleep(self, seconds: float):
+        time.sleep(max(0, seconds) / self.factor)
+
+    def timeout(self, seconds: float) -> float:
+        if seconds is None:
+            return None
+        return max(0, seconds) / self.factor
+
+
+def get_clock() -> Clock:
+    # BIOTICA_TIME_WARP=3600 runs an hour of protocol per second of wall time
+    global _clock
+    if _clock is None:
+        factor = float(os.getenv("BIOTICA_TIME_WARP", "1"))
+        _clock = WarpClock(factor) if factor != 1 else Clock()
+    return _clock
@@ -0,0 +1,92 @@
+# compaction.py
+from collections import deque
+
+from openai import OpenAI
+
+
+class ThreadCompactor:
+
+    MAX_MESSAGES = 150
+    MAX_CHARS = 150000 # roughly 40k tokens of history
+    TRANSCRIPT_CHARS = 60000 # most recent history handed to the summarizer
+    RECENT_TOOL_RESULTS = 200
+    MODEL = "gpt-4o"
+
+    SUMMARY_PROMPT = (
+        "You are summarizing the history of an AI agent that is training two mice in a cage to press a lever.\n"
+        "The agent controls a water dispenser, a speaker and two levers through function calls. Its conversation has grown too long "
+        "and will be replaced by your summary, so include everything it needs to continue without the history: the strategy it has "
+        "been following, what it tried and how the mice responded, what seems to work, any advice it received from humans, "
+        "and what it was planning to do next. Be specific about frequencies, durations and counts.\n\n"
+        "Current behavior statistics:\n{stats}\n\n"
+        "Recent function calls and results:\n{tool_results}\n\n"
+        "Conversation (oldest first):\n{transcript}\n"
+    )
+
+    SEED_PROMPT = (
+        "\nThis is a continuation of an experiment that has already been running. "
+        "Here is a summary of what happened so far:\n\n{summary}\n\n"
+        "Behavior statistics at the time of this summary:\n{stats}\n"
+    )
+
+    def __init__(self, client: OpenAI):
+        self.client = client
+        self.messages = 0
+        self.chars = 0
+        self.tool_results = deque(maxlen=self.RECENT_TOOL_RESULTS)
+
+    def observe(self, text: str):
+        self.messages += 1
+        self.chars += len(text)
+
+    def observe_tool_result(self, name: str, arguments: str, output: str):
+        line = f"{name}({arguments}) -> {output}"
+        self.tool_results.append(line)
+        self.observe(line)
+
+    def needs_compaction(self) -> bool:
+        return self.messages >= self.MAX_MESSAGES or self.chars >= self.MAX_CHARS
+
+    def _transcript(self, thread_id: str) -> str:
+        # Newest first until the budget is spent, then put back in order
+        lines = []
+        used = 0
+        for message in self.client.beta.threads.messages.list(thread_id, order="desc", limit=100):
+            text = " ".join(block.text.value for block in message.content if block.type == "text")
+            line = f"{message.role}: {text}"
+            if used + len(line) > self.TRANSCRIPT_CHARS:
+                break
+            lines.append(line)
+            used += len(line)
+        return "\n".join(reversed(lines))
+
+    def compact(self, thread_id: str, thread_prompt: str, stats: str) -> tuple:
+        # Returns (new thread, summary)
+        prompt = self.SUMMARY_PROMPT.format(
+            stats=stats,
+            tool_results="\n".join(self.tool_results) or "(none)",
+            transcript=self._transcript(thread_id),
+        )
+        summary = self.client.chat.completions.create(
+            model=self.MODEL,
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+        ).choices[0].message.content
+
+        seed = thread_prompt + self.SEED_PROMPT.format(summary=summary, stats=stats)
+        thread = self.client.beta.threads.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": seed
+                }
+            ]
+        )
+        self.messages = 1
+        self.chars = len(seed)
+        self.tool_results.clear()
+        return thread, summary
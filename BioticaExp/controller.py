@@ -1,14 +1,159 @@
 
-import RPi.GPIO as GPIO
-import time
 from enum import Enum
-from openai import OpenAI
 import threading
+import heapq
+import itertools
+import math
+from metrics import Histogram, REGISTRY
+import hardware
+from clock import Clock, get_clock
+from trials import TrialRunner
+from levers import LeverEventRing, LeverInput
+from eventstore import EventStore, Device, EventType
+from stats import BehaviorStats
+from helpdesk import HelpDesk
+from reasoning import ReasoningError, ReasoningService
+import json
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import OpenAI # only for annotations; the hardware side never imports openai
+
+
+class LeverPress(int):
+    # Behaves like the -1/0/1 lever index but also carries when the press happened
+
+    def __new__(cls, lever: int, timestamp: float = None, monotonic: float = None):
+        press = super().__new__(cls, lever)
+        press.timestamp = timestamp # wall clock time of the edge
+        press.monotonic = monotonic
+        return press
+
+
+class ActionHandle:
+
+    def __init__(self, on_cancel=None):
+        self.result = None
+        self._on_cancel = on_cancel
+        self._cancelled = False
+        self._started = False
+        self._callbacks = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def completed(cls, result) -> "ActionHandle":
+        handle = cls()
+        handle._finish(result)
+        return handle
+
+    def cancel(self) -> bool:
+        with self._lock:
+            if self._done.is_set() or self._cancelled or self._started:
+                return False
+            self._cancelled = True
+        if self._on_cancel:
+            self._on_cancel() # the owner winds the action down and finishes the handle
+        else:
+            self._finish(None)
+        return True
+
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn):
+        # fn(handle) runs on the thread that finishes the handle, or right away if already done
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _start(self) -> bool:
+        # Claimed by the scheduler right before the action runs; it can no longer be cancelled
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._started = True
+            return True
+
+    def _finish(self, result):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.result = result
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class Scheduler:
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="actuator-scheduler")
+        self._thread.start()
+
+    def call_at(self, deadline: float, fn, *args) -> ActionHandle:
+        # deadline is on the clock's monotonic() timeline
+        handle = ActionHandle()
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), handle, fn, args))
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        return handle
+
+    def call_later(self, delay: float, fn, *args) -> ActionHandle:
+        return self.call_at(self.clock.monotonic() + delay, fn, *args)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    if self._heap:
+                        remaining = self._heap[0][0] - self.clock.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(self.clock.timeout(remaining))
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    return
+                _, _, handle, fn, args = heapq.heappop(self._heap)
+            if not handle._start():
+                continue
+            try:
+                handle._finish(fn(*args))
+            except Exception as e:
+                print(f"Error running scheduled action: {e}")
+                handle._finish(None)
+
 
 class MainController:
 
     HUMAN_TIMEOUT = 60*60 # 1 hour
+    HUMAN_WAIT = 2*60 # how long get_human_help waits for an answer before returning a ticket
     REASONING_TIMEOUT = 60*60 # 1 hour
+    REASONING_WAIT = 30 # how long get_reasoning_help waits before the answer is delivered as a message instead
+    PREFETCH_SESSIONS = 6 # prefetch reasoning advice after every this many stats sessions
 
     LEFT_LEVER_LED = 8
     RIGHT_LEVER_LED = 1
@@ -17,122 +162,533 @@ class MainController:
 
     MIN_FREQ = 50
     MAX_FREQ = 10000
+    MAX_PATTERN_SEGMENTS = 50
+    MAX_PATTERN_REPEAT = 100
+    MAX_PATTERN_DURATION = 3*60
+
+    LED_ON_TIME = 3 # seconds a lever LED stays lit after a press
+    LEVER_DEBOUNCE = (0.01, 0.01) # default seconds of contact bounce ignored after each edge, per lever
+    STATS_HISTORY = 7*24*60*60 # 1 week of stored events is replayed into the stats on start
 
     class LeverState(Enum):
         UNPRESSED = 0
         PRESSED = 1
 
-    def __init__(self, client: OpenAI=None, engine=None):
-        GPIO.setmode(GPIO.BCM)
-
-        GPIO.setup(self.LEFT_LEVER_LED, GPIO.OUT)
-        GPIO.output(self.LEFT_LEVER_LED, GPIO.LOW)
-        GPIO.setup(self.RIGHT_LEVER_LED, GPIO.OUT)
-        GPIO.output(self.RIGHT_LEVER_LED, GPIO.LOW)
-
-        GPIO.setup(self.LEFT_LEVER_SWITCH, GPIO.IN, pull_up_down=GPIO.PUD_UP) 
-        GPIO.setup(self.RIGHT_LEVER_SWITCH, GPIO.IN, pull_up_down=GPIO.PUD_UP) 
-        GPIO.add_event_detect(self.LEFT_LEVER_SWITCH, GPIO.FALLING, callback=self._left_lever_callback, bouncetime=300)
-        GPIO.add_event_detect(self.RIGHT_LEVER_SWITCH, GPIO.FALLING, callback=self._right_lever_callback, bouncetime=300)
-
-        self.engine = engine
-        self.client = client
-        self.feeder = Feeder()
-        self.speaker = Speaker()
+    # Keys accepted in the pins map; anything not given keeps the default above
+    PIN_NAMES = (
+        "LEFT_LEVER_LED", "RIGHT_LEVER_LED", "LEFT_LEVER_SWITCH", "RIGHT_LEVER_SWITCH",
+        "FEEDER_PINS", "FEEDER_SWITCH_PIN", "SPEAKER_PIN", "SPEAKER_LED",
+    )
+
+    def __init__(
+        self,
+        client: "OpenAI"=None,
+        engine=None,
+        gpio=None,
+        clock: Clock=None,
+        events: EventStore=None,
+        pins: dict=None,
+        data_dir: str=".",
+        name: str=None,
+        debounce: tuple=None,
+    ):
+        # pins remaps the GPIO lines, e.g. for a second cage on the same Pi; data_dir
+        # holds the event store, help spool and reasoning cache; name labels the metrics;
+        # debounce is (left, right) in seconds and replaces LEVER_DEBOUNCE
+        pins = pins or {}
+        unknown = set(pins) - set(self.PIN_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown pins: {', '.join(sorted(unknown))}")
+        debounce = tuple(self.LEVER_DEBOUNCE if debounce is None else debounce)
+        if len(debounce) != 2 or any(d < 0 for d in debounce):
+            raise ValueError(f"debounce must be two non-negative durations, left and right, not {debounce}")
+        for pin_name in ("LEFT_LEVER_LED", "RIGHT_LEVER_LED", "LEFT_LEVER_SWITCH", "RIGHT_LEVER_SWITCH"):
+            if pin_name in pins:
+                setattr(self, pin_name, pins[pin_name])
+        self.gpio = gpio or hardware.get_backend()
+        self.clock = clock or get_clock()
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self.events = events or EventStore(os.path.join(data_dir, "events.bin"))
+        self.gpio.setmode(self.gpio.BCM)
+
+        self.gpio.setup(self.LEFT_LEVER_LED, self.gpio.OUT)
+        self.gpio.output(self.LEFT_LEVER_LED, self.gpio.LOW)
+        self.gpio.setup(self.RIGHT_LEVER_LED, self.gpio.OUT)
+        self.gpio.output(self.RIGHT_LEVER_LED, self.gpio.LOW)
+
+        self.gpio.setup(self.LEFT_LEVER_SWITCH, self.gpio.IN, pull_up_down=self.gpio.PUD_UP) 
+        self.gpio.setup(self.RIGHT_LEVER_SWITCH, self.gpio.IN, pull_up_down=self.gpio.PUD_UP) 
+
+        self.scheduler = Scheduler(self.clock)
+        self.feeder = Feeder(self.gpio, self.scheduler, pins.get("FEEDER_PINS"), pins.get("FEEDER_SWITCH_PIN"))
+        self.speaker = Speaker(self.gpio, self.scheduler, pins.get("SPEAKER_PIN"), pins.get("SPEAKER_LED"))
+        if not hardware.is_simulated(self.gpio) and hardware.is_headless():
+            self.home_feeder() # nobody to check that it is lifted
+        self._led_off = [None, None] # pending LED-off actions per lever
         self.lever_state = [
             self.LeverState.UNPRESSED, # left lever
             self.LeverState.UNPRESSED, # right lever
         ]
+        self.lever_events = LeverEventRing()
+        self._lever_cond = threading.Condition()
+        self._lever_press = None # (lever, wall time, monotonic time) of the first press in a wait
+        self._press_waiters = [] # handles from next_press()
+        self._waits = 0 # lever waits and trial blocks in progress; presses during one are theirs
+        labels = {"cage": name} if name else {}
+        self.lever_latency = REGISTRY.histogram(
+            "biotica_lever_edge_to_return_seconds", "Lever edge to wait_for_lever returning", **labels
+        )
+        REGISTRY.register(
+            "biotica_tone_step_lateness_seconds", self.speaker.lateness, "Tone sequencer steps behind their deadline", **labels
+        )
+        self.trial_runner = TrialRunner(self)
+        self.stats = BehaviorStats()
+        self.stats.load(self.events, since=self.clock.time() - self.STATS_HISTORY)
+        self.reasoning = None
+        self.engine = None
+        self._undelivered = [] # answers for the agent that came before the engine
+        self.attach(engine, client)
+        self._sessions_ended = 0
+        self.stats.on_session_end = self._session_ended # after load, so replayed history does not trigger it
+        self.help_desk = HelpDesk(os.path.join(data_dir, "help_spool"), self.clock, on_answer=self._deliver_help)
         self._last_human_help = 0
         self._last_reasoning_help = 0
 
-    def _left_lever_callback(self, channel):
-        if self.engine.lever_status != "waiting":
-            self.engine.write_to_pipe("The left lever was recently pressed by the mouse.")
-            print("left lever interrupt")
-        self.lever_state[0] = self.LeverState.PRESSED
-        GPIO.output(self.LEFT_LEVER_LED, GPIO.HIGH)
-        threading.Timer(3, GPIO.output, args=(self.LEFT_LEVER_LED, GPIO.LOW)).start()
-        
-    def _right_lever_callback(self, channel):
-        if self.engine.lever_status != "waiting":
-            self.engine.write_to_pipe("The right lever was recently pressed by the mouse.")
-            print("right lever interrupt")
-        self.lever_state[1] = self.LeverState.PRESSED
-        GPIO.output(self.RIGHT_LEVER_LED, GPIO.HIGH)
-        threading.Timer(3, GPIO.output, args=(self.RIGHT_LEVER_LED, GPIO.LOW)).start()
+        # Both edges, debounced in software; a hardware bouncetime would drop fast presses
+        self.levers = [
+            LeverInput(
+                self.gpio, pin, self.scheduler, debounce[lever],
+                on_press=lambda edge, lever=lever: self._lever_pressed(lever, edge),
+                on_release=lambda edge, hold, lever=lever: self._lever_released(lever, edge, hold),
+            )
+            for lever, pin in enumerate([self.LEFT_LEVER_SWITCH, self.RIGHT_LEVER_SWITCH])
+        ]
+        for lever in self.levers:
+            self.gpio.add_event_detect(lever.pin, self.gpio.BOTH, callback=lever.edge)
+        self.problems = self.self_test()
+        for problem in self.problems:
+            print(f"Self-test: {problem}")
+
+    def attach(self, engine, client: "OpenAI"=None):
+        # The hardware can come up before the engine and its API client exist; presses
+        # until then are kept in lever_events like any other
+        self.client = client
+        if client and self.reasoning is None:
+            self.reasoning = ReasoningService(
+                client, self.clock, path=os.path.join(self.data_dir, "reasoning_cache.json"), on_answer=self._deliver_reasoning
+            )
+        with self._lever_cond:
+            self.engine = engine
+            undelivered = []
+            if engine is not None:
+                undelivered, self._undelivered = self._undelivered, []
+        for message in undelivered:
+            engine._interrupt(message)
+
+    def self_test(self) -> list:
+        # Quick check of the GPIO lines; returns the problems found. Lights are driven
+        # and read back; the feeder coils are only read back so the motor never moves
+        problems = []
+        for pin in [self.LEFT_LEVER_LED, self.RIGHT_LEVER_LED, self.speaker.SPEAKER_LED]:
+            for level in (self.gpio.HIGH, self.gpio.LOW):
+                self.gpio.output(pin, level)
+                if self.gpio.input(pin) != level:
+                    problems.append(f"output {pin} does not read back {level}")
+                    break
+        for pin, level in zip(self.feeder.PINS, self.feeder.stepper.outputs):
+            if self.gpio.input(pin) != level:
+                problems.append(f"feeder coil {pin} does not read back {level}")
+        for lever, pin in zip(["left", "right"], [self.LEFT_LEVER_SWITCH, self.RIGHT_LEVER_SWITCH]):
+            if self.gpio.input(pin) == self.gpio.LOW:
+                problems.append(f"{lever} lever switch {pin} reads pressed; check it is not stuck or shorted")
+        return problems
+
+    @classmethod
+    def pin_map(cls, pins: dict = None) -> dict:
+        # Every GPIO line a controller with these overrides drives or reads, by pin name
+        pins = pins or {}
+        unknown = set(pins) - set(cls.PIN_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown pins: {', '.join(sorted(unknown))}")
+        lines = {
+            "LEFT_LEVER_LED": cls.LEFT_LEVER_LED,
+            "RIGHT_LEVER_LED": cls.RIGHT_LEVER_LED,
+            "LEFT_LEVER_SWITCH": cls.LEFT_LEVER_SWITCH,
+            "RIGHT_LEVER_SWITCH": cls.RIGHT_LEVER_SWITCH,
+            "FEEDER_PINS": Feeder.PINS,
+            "FEEDER_SWITCH_PIN": Feeder.SWITCH_PIN,
+            "SPEAKER_PIN": Speaker.SPEAKER_PIN,
+            "SPEAKER_LED": Speaker.SPEAKER_LED,
+        }
+        lines.update(pins)
+        return lines
+
+    def _wall_time(self, monotonic: float) -> float:
+        return self.clock.time() - (self.clock.monotonic() - monotonic)
+
+    def _record_press(self, lever: int, edge: float):
+        timestamp = self._wall_time(edge)
+        # The engine reads presses from the ring; presses outside a wait interrupt the agent
+        self.lever_events.append(lever, timestamp, edge, self.waiting)
+        self.events.append(timestamp, Device(lever), EventType.PRESS)
+        self.stats.on_press(lever, timestamp)
+        with self._lever_cond:
+            self.lever_state[lever] = self.LeverState.PRESSED
+            if self._lever_press is None:
+                self._lever_press = (lever, timestamp, edge)
+            self._lever_cond.notify_all()
+            waiters, self._press_waiters = self._press_waiters, []
+        for handle in waiters:
+            handle._finish(LeverPress(lever, timestamp, edge))
+
+    def next_press(self) -> ActionHandle:
+        # Finishes with a LeverPress on the next press; cancel() stops waiting.
+        # wait_for_lever without blocking a thread, for the asyncio engine
+        def drop():
+            with self._lever_cond:
+                if handle in self._press_waiters:
+                    self._press_waiters.remove(handle)
+            handle._finish(None)
+        handle = ActionHandle(on_cancel=drop)
+        with self._lever_cond:
+            self._press_waiters.append(handle)
+        return handle
+
+    def _lever_pressed(self, lever: int, edge: float):
+        self._record_press(lever, edge)
+        self._flash_led(lever, [self.LEFT_LEVER_LED, self.RIGHT_LEVER_LED][lever])
+
+    def _lever_released(self, lever: int, edge: float, hold: float):
+        timestamp = self._wall_time(edge)
+        self.events.append(timestamp, Device(lever), EventType.RELEASE, hold)
+        self.stats.on_release(lever, hold)
+
+    def _flash_led(self, lever: int, led: int):
+        # Repeated presses push the LED-off deadline back instead of stacking timers
+        if self._led_off[lever]:
+            self._led_off[lever].cancel()
+        self.gpio.output(led, self.gpio.HIGH)
+        self._led_off[lever] = self.scheduler.call_later(self.LED_ON_TIME, self.gpio.output, led, self.gpio.LOW)
+
+    def home_feeder(self):
+        # Homing brings the spout down to the animal, so it is logged, as its own event
+        # type so that it never counts as a reward
+        homed = False
+        try:
+            self.feeder.home()
+            homed = True
+        finally:
+            self.events.append(self.clock.time(), Device.FEEDER, EventType.HOME, homed)
+
+    def start_feed(self, duration: int) -> ActionHandle:
+        handle = self.feeder.feed(duration)
+        if not handle.done():
+            self.events.append(self.clock.time(), Device.FEEDER, EventType.FEED_START, duration)
+            handle.add_done_callback(self._feed_done)
+        return handle
+
+    def _feed_done(self, handle: ActionHandle):
+        now = self.clock.time()
+        self.events.append(now, Device.FEEDER, EventType.FEED_END, bool(handle.result))
+        if handle.result:
+            self.stats.on_reward(now)
+
+    def start_sound(self, duration: int, frequency: int) -> ActionHandle:
+        return self.start_sequence(ToneSequence.tone(duration, frequency))
+
+    def start_sequence(self, sequence: "ToneSequence") -> ActionHandle:
+        # Tone onsets and offsets are stored as they actually happen; each repeat of a
+        # pattern counts as one cue for the stats
+        def on_edge(edge):
+            now = self.clock.time()
+            if edge[0] == "on":
+                _, frequency, duration, first = edge
+                self.events.append(now, Device.SPEAKER, EventType.TONE_ON, frequency, duration)
+                if first:
+                    self.stats.on_tone(now)
+            else:
+                self.events.append(now, Device.SPEAKER, EventType.TONE_OFF, edge[1])
+        return self.speaker.play_sequence(sequence, on_edge)
 
     def feed(self, duration: int) -> bool:
-        return self.feeder.feed(duration)
+        handle = self.start_feed(duration)
+        handle.wait()
+        return bool(handle.result)
 
     def play_sound(self, duration: int, frequency: int) -> bool:
         if frequency < self.MIN_FREQ or frequency > self.MAX_FREQ:
             return False
-        return self.speaker.play(duration, frequency)
-
-    def wait_for_lever(self, duration: int) -> int:
-        self.engine.lever_status = "waiting"
-        self.lever_state[0] = self.LeverState.UNPRESSED
-        self.lever_state[1] = self.LeverState.UNPRESSED
-        start_time = time.time()
-        while (time.time() - start_time < duration) and \
-        (self.lever_state[0] == self.LeverState.UNPRESSED) and \
-        (self.lever_state[1] == self.LeverState.UNPRESSED):
-            time.sleep(0.1)
-        if self.lever_state[0] == self.LeverState.PRESSED:
-            return 0 # left lever   
-        elif self.lever_state[1] == self.LeverState.PRESSED:
-            return 1 # right lever
-        return -1 # neither lever
+        handle = self.start_sound(duration, frequency)
+        handle.wait()
+        return bool(handle.result)
+
+    def play_pattern(self, segments: list, repeat: int) -> str:
+        error = self._validate_pattern(segments, repeat)
+        if error:
+            return json.dumps({"error": error})
+        sequence = ToneSequence(segments, repeat)
+        self.start_sequence(sequence)
+        # Returns at onset; the pattern keeps playing while the agent does other things
+        return json.dumps({"started": True, "duration": round(sequence.duration, 3)})
+
+    def _validate_pattern(self, segments: list, repeat: int) -> str:
+        if not segments or len(segments) > self.MAX_PATTERN_SEGMENTS:
+            return f"a pattern needs between 1 and {self.MAX_PATTERN_SEGMENTS} segments"
+        if not 1 <= repeat <= self.MAX_PATTERN_REPEAT:
+            return f"repeat must be between 1 and {self.MAX_PATTERN_REPEAT}"
+        for segment in segments:
+            if segment["kind"] not in ("tone", "sweep", "gap"):
+                return "kind must be one of tone, sweep or gap"
+            if segment["duration"] < 0:
+                return "durations cannot be negative"
+            frequencies = {"tone": [segment["frequency"]], "sweep": [segment["frequency"], segment["end_frequency"]], "gap": []}
+            if any(f < self.MIN_FREQ or f > self.MAX_FREQ for f in frequencies[segment["kind"]]):
+                return f"frequencies must be between {self.MIN_FREQ} and {self.MAX_FREQ} Hz"
+        duration = sum(segment["duration"] for segment in segments) * repeat
+        if duration > self.MAX_PATTERN_DURATION:
+            return f"the pattern lasts {duration:.0f} seconds, the maximum is {self.MAX_PATTERN_DURATION} seconds"
+        return None
+
+    @property
+    def waiting(self) -> bool:
+        return self._waits > 0
+
+    def begin_wait(self):
+        # Counted rather than a flag so that overlapping waits cannot leave it set or cleared
+        with self._lever_cond:
+            self._waits += 1
+
+    def end_wait(self):
+        with self._lever_cond:
+            self._waits -= 1
+
+    def wait_for_lever(self, duration: int) -> LeverPress:
+        self.begin_wait()
+        try:
+            with self._lever_cond:
+                self.lever_state[0] = self.LeverState.UNPRESSED
+                self.lever_state[1] = self.LeverState.UNPRESSED
+                self._lever_press = None
+                # The lever callbacks notify directly, so this wakes as soon as a press lands
+                self._lever_cond.wait_for(lambda: self._lever_press is not None, timeout=self.clock.timeout(duration))
+                press = self._lever_press
+        finally:
+            self.end_wait()
+        if press is None:
+            return LeverPress(-1) # neither lever
+        lever, timestamp, edge = press
+        self.lever_latency.observe(self.clock.monotonic() - edge)
+        return LeverPress(lever, timestamp, edge) # 0 left lever, 1 right lever
 
     def delay(self, duration: int) -> bool:
-        time.sleep(duration)
+        self.clock.sleep(duration)
         return True
 
+    def get_stats(self) -> str:
+        return json.dumps(self.stats.summary(self.clock.time()))
+
+    def run_trials(
+        self,
+        tone_frequency: int,
+        tone_duration: int,
+        response_window: int,
+        rewarded_lever: str,
+        reward_duration: int,
+        inter_trial_interval: int,
+        repeat: int,
+    ) -> str:
+        return self.trial_runner.run({
+            "tone_frequency": tone_frequency,
+            "tone_duration": tone_duration,
+            "response_window": response_window,
+            "rewarded_lever": rewarded_lever,
+            "reward_duration": reward_duration,
+            "inter_trial_interval": inter_trial_interval,
+            "repeat": repeat,
+        })
+
     def get_human_help(self, request: str) -> str:
-        if time.time() - self._last_human_help >= self.HUMAN_TIMEOUT:
-            self._last_human_help = time.time()
-            rsp = str(input(request + ":\n\n"))
-            print(f"human response: {rsp}")
-            return rsp
+        if self.clock.time() - self._last_human_help >= self.HUMAN_TIMEOUT:
+            self._last_human_help = self.clock.time()
+            # Never blocks for longer than HUMAN_WAIT; a later answer arrives as a message
+            ticket = self.help_desk.ask(request)
+            rsp = self.help_desk.wait(ticket, self.HUMAN_WAIT)
+            if rsp is not None:
+                return rsp
+            return (
+                f"No human has answered yet. Your request was queued as ticket {ticket} and the answer "
+                "will be sent to you as a message as soon as it arrives. Carry on training in the meantime."
+            )
         return (
             "You can only use the get_human_help function once every 24 hours.\n"
-            "You last used it " + str(time.time() - self._last_human_help) + " seconds ago.\n"
-            "Please wait " + str(self.HUMAN_TIMEOUT - (time.time() - self._last_human_help)) + " seconds before using it again.\n"
+            "You last used it " + str(self.clock.time() - self._last_human_help) + " seconds ago.\n"
+            "Please wait " + str(self.HUMAN_TIMEOUT - (self.clock.time() - self._last_human_help)) + " seconds before using it again.\n"
         )
     
-    def get_reasoning_help(self, request: str) -> str:
-        prompt = (
-            "You are a helpful assistant that helps another smaller LLM with complex reasoning tasks.\n"
-            "The smaller LLM is working on training two mice in a cage to perform certain tasks.\n"
-            "Here is the LLM's request for help:\n"
-            + request + "\n\n"
-            "Try to give the smaller LLM a detailed strategy that is based on scientific evidence and studies.\n"
-        )
-
-        if time.time() - self._last_reasoning_help >= self.REASONING_TIMEOUT:
-            self._last_reasoning_help = time.time()
-            return self.client.chat.completions.create(
-                model="o1",
-                messages=[
-                    {
-                        "role": "user", 
-                        "content": prompt
-                    }
-                ]
-            ).choices[0].message.content
+    def _deliver_help(self, ticket: str, request: str, answer: str):
+        self._deliver(f"A human answered your help request {ticket} (\"{request}\"): {answer}")
+
+    def _deliver_reasoning(self, request: str, answer: str, error: str = None):
+        if error is not None:
+            self._deliver(f"ERROR: the reasoning model could not answer your request (\"{request}\"): {error}. You can ask again.")
+            return
+        self._deliver(f"The reasoning model answered your request (\"{request}\"):\n{answer}")
+
+    def _deliver(self, message: str):
+        # Answers that arrive before an engine is attached, e.g. one left in the help
+        # spool across a restart, wait for attach()
+        with self._lever_cond:
+            engine = self.engine
+            if engine is None:
+                self._undelivered.append(message)
+                return
+        engine._interrupt(message)
+
+    def _session_ended(self, session: dict):
+        self._sessions_ended += 1
+        if self.reasoning and self._sessions_ended % self.PREFETCH_SESSIONS == 0:
+            # Summarized on the reasoning thread; the stats lock is held here
+            self.reasoning.executor.submit(lambda: self.reasoning.prefetch_milestone(self.get_stats()))
 
-        return (
+    def get_reasoning_help(self, request: str) -> str:
+        # Repeated questions are answered from the cache and do not count against the limit
+        answer = self.reasoning.cached(request)
+        if answer is not None:
+            return answer
+
+        if self.clock.time() - self._last_reasoning_help >= self.REASONING_TIMEOUT:
+            last, self._last_reasoning_help = self._last_reasoning_help, self.clock.time()
+            try:
+                answer = self.reasoning.ask(request, self.REASONING_WAIT)
+            except ReasoningError as e:
+                # A failed call does not use up the hourly allowance
+                self._last_reasoning_help = last
+                return f"ERROR: the reasoning model could not answer this request: {e}. You can ask again."
+            if answer is not None:
+                return answer
+            return (
+                "The reasoning model is still working on your request. Its answer will be sent to you as a message "
+                "as soon as it is ready. Carry on training in the meantime."
+            )
+
+        rsp = (
             "You can only use the get_reasoning_help function once every hour.\n"
-            "You last used it " + str(time.time() - self._last_reasoning_help) + " seconds ago.\n"
-            "Please wait " + str(self.REASONING_TIMEOUT - (time.time() - self._last_reasoning_help)) + " seconds before using it again.\n"
+            "You last used it " + str(self.clock.time() - self._last_reasoning_help) + " seconds ago.\n"
+            "Please wait " + str(self.REASONING_TIMEOUT - (self.clock.time() - self._last_reasoning_help)) + " seconds before using it again.\n"
         )
+        advice = self.reasoning.take_milestone()
+        if advice:
+            rsp += "\nAdvice prepared from your latest behavior statistics:\n" + advice
+        return rsp
     
     def cleanup(self):
-        GPIO.output(self.LEFT_LEVER_LED, GPIO.LOW)
-        GPIO.output(self.RIGHT_LEVER_LED, GPIO.LOW)
+        self.gpio.output(self.LEFT_LEVER_LED, self.gpio.LOW)
+        self.gpio.output(self.RIGHT_LEVER_LED, self.gpio.LOW)
         self.feeder.cleanup()
         self.speaker.cleanup()
+        self.scheduler.stop()
+        self.help_desk.close()
+        if self.reasoning:
+            self.reasoning.close()
+        self.events.close()
+
+
+class MotionProfile:
+
+    def __init__(self, start_rate: float, max_rate: float, accel: float):
+        # Rates are in phases per second, accel in phases per second squared
+        self.start_rate = start_rate
+        self.max_rate = max_rate
+        self.accel = accel
+        self.ramp = self._build_ramp()
+
+    def _build_ramp(self) -> tuple:
+        # Interval before each phase while speeding up from start_rate to max_rate
+        intervals = []
+        n = 0
+        while True:
+            rate = min((self.start_rate ** 2 + 2 * self.accel * n) ** 0.5, self.max_rate)
+            intervals.append(1 / rate)
+            if rate >= self.max_rate:
+                return tuple(intervals)
+            n += 1
+
+    def interval(self, step: int, remaining: int = None) -> float:
+        # Accelerate from the start of the move and decelerate into a known end
+        i = step if remaining is None else min(step, remaining - 1)
+        return self.ramp[min(i, len(self.ramp) - 1)]
+
+
+class Stepper:
+
+    # Half-step phase table for a 4-wire unipolar motor
+    HALF_STEP_SEQUENCE = (
+        (1,0,0,0),
+        (1,1,0,0),
+        (0,1,0,0),
+        (0,1,1,0),
+        (0,0,1,0),
+        (0,0,1,1),
+        (0,0,0,1),
+        (1,0,0,1),
+    )
+
+    def __init__(self, gpio, pins: list, scheduler: Scheduler, profile: MotionProfile):
+        self.gpio = gpio
+        self.pins = list(pins)
+        self.scheduler = scheduler
+        self.profile = profile
+        self._phase = 0
+        self.outputs = (0, 0, 0, 0) # coil levels last written
+
+    def _advance(self, direction: int):
+        # Stepping from the current phase keeps reversals from skipping a step
+        self._phase = (self._phase + direction) % len(self.HALF_STEP_SEQUENCE)
+        self.outputs = self.HALF_STEP_SEQUENCE[self._phase]
+        self.gpio.output(self.pins, self.outputs)
+
+    def _phases(self, direction: int, steps: int, until, limit: int = None):
+        n = 0
+        while until is not None and until():
+            if limit is not None and n >= limit:
+                raise RuntimeError(f"still moving after {limit} phases")
+            self._advance(direction)
+            yield self.profile.interval(n)
+            n += 1
+        for remaining in range(steps, 0, -1):
+            self._advance(direction)
+            yield self.profile.interval(n, remaining)
+            n += 1
+
+    def move(self, direction: int, steps: int = 0, until=None, limit: int = None) -> ActionHandle:
+        # Step while until() holds, at most `limit` phases, then `steps` more phases. Result
+        # is True when the move completes, False when cancelled and None on a GPIO error
+        # or when the limit is reached.
+        handle = ActionHandle(on_cancel=lambda: None) # cancellation is checked between phases
+        phases = self._phases(direction, steps, until, limit)
+
+        def tick(deadline):
+            if handle.cancelled():
+                handle._finish(False)
+                return
+            try:
+                interval = next(phases)
+            except StopIteration:
+                handle._finish(True)
+                return
+            except Exception as e:
+                print(f"Error moving stepper: {e}")
+                handle._finish(None)
+                return
+            # Deadlines advance from the previous deadline, not from when this tick ran,
+            # but resync after a stall instead of bursting to catch up
+            deadline = max(deadline + interval, self.scheduler.clock.monotonic() - interval)
+            self.scheduler.call_at(deadline, tick, deadline)
+
+        now = self.scheduler.clock.monotonic()
+        self.scheduler.call_at(now, tick, now)
+        return handle
 
 
 class Feeder:
@@ -142,101 +698,279 @@ class Feeder:
         FEEDING = 1
 
     class Direction(Enum):
-        LOWER_FEED = 0
-        LIFT_FEED = 1
+        LOWER_FEED = 1
+        LIFT_FEED = -1
        
 
     # GPIO pins
     PINS = [17, 18, 27, 22]
     SWITCH_PIN = 16
 
-    # Stepper motor step sequence
-    STEP_SEQUENCE = [
-        [1,0,0,0],
-        [0,1,0,0],
-        [0,0,1,0],
-        [0,0,0,1]
-    ]
+    LIFT_STEPS = 200 # full 4-step cycles lifted past the switch
+    LIFT_PHASES = LIFT_STEPS * 8 # the same travel in half-steps
+    HOME_LIMIT = LIFT_PHASES * 2 # half-steps moved looking for the switch before giving up
 
-    LIFT_STEPS = 200
+    PROFILE = MotionProfile(start_rate=200, max_rate=800, accel=4000)
 
-    def __init__(self):
-        GPIO.setmode(GPIO.BCM)
+    def __init__(self, gpio, scheduler: Scheduler, pins: list = None, switch_pin: int = None):
+        self.gpio = gpio
+        self.gpio.setmode(self.gpio.BCM)
+        if pins is not None:
+            self.PINS = list(pins)
+        if switch_pin is not None:
+            self.SWITCH_PIN = switch_pin
         self._setup_gpio()
-
-        input("Verify feeder is lifted and press enter to continue...")
-        if GPIO.input(self.SWITCH_PIN) != GPIO.HIGH:
-            raise Exception("Feeder is not lifted")
+        self.scheduler = scheduler
+        self.stepper = Stepper(gpio, self.PINS, scheduler, self.PROFILE)
+
+        # Headless, MainController homes the feeder once it can log it; the simulated
+        # feeder always starts lifted
+        if not hardware.is_simulated(gpio) and not hardware.is_headless():
+            input("Verify feeder is lifted and press enter to continue...")
+            if self.gpio.input(self.SWITCH_PIN) != self.gpio.HIGH:
+                raise Exception("Feeder is not lifted")
         self.state = self.State.IDLE
+        self._handle = None
+        self._motion = None
+        self._raise_timer = None
+
+    @classmethod
+    def cycle_time(cls) -> float:
+        # Expected seconds to lower the spout and lift it again, drinking time not included
+        travel = sum(cls.PROFILE.interval(n, cls.LIFT_PHASES - n) for n in range(cls.LIFT_PHASES))
+        return 2 * travel
 
     def _setup_gpio(self):
         for p in self.PINS:
-            GPIO.setup(p, GPIO.OUT)
-            GPIO.output(p, False)
-        GPIO.setup(self.SWITCH_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)  # Pull-up enabled
+            self.gpio.setup(p, self.gpio.OUT)
+            self.gpio.output(p, False)
+        self.gpio.setup(self.SWITCH_PIN, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)  # Pull-up enabled
 
-    def _step(self, direction: Direction):
-        
+    def _move(self, direction: Direction, steps: int = 0, until=None, limit: int = None) -> ActionHandle:
         # (TODO) this is a stub, it may be reversed -- need to check hardware setup
-        step_sequence = self.STEP_SEQUENCE if direction == self.Direction.LOWER_FEED else list(reversed(self.STEP_SEQUENCE))
-        for step in step_sequence:
-            for pin, val in zip(self.PINS, step):
-                GPIO.output(pin, val)
-            time.sleep(0.01)
-
-    def _lower_feeder(self):
-        while GPIO.input(self.SWITCH_PIN) == GPIO.HIGH:
-            self._step(self.Direction.LOWER_FEED)
-
-    def _raise_feeder(self):
-        while GPIO.input(self.SWITCH_PIN) == GPIO.LOW:
-            self._step(self.Direction.LIFT_FEED)
-        for _ in range(self.LIFT_STEPS):
-            self._step(self.Direction.LIFT_FEED)
+        return self.stepper.move(direction.value, steps, until, limit)
+
+    def home(self):
+        # The switch only reads LOW at the bottom of the travel, so a feeder stopped
+        # partway, e.g. by a power cut, reads the same as a lifted one. Lower to the
+        # switch, then do the full lift every feed ends with. The spout comes down
+        # briefly, so call it through MainController.home_feeder, which logs it
+        print("Homing feeder...")
+        for direction, steps, level in [
+            (self.Direction.LOWER_FEED, 0, self.gpio.HIGH),
+            (self.Direction.LIFT_FEED, self.LIFT_PHASES, self.gpio.LOW),
+        ]:
+            motion = self._move(
+                direction,
+                steps=steps,
+                until=lambda level=level: self.gpio.input(self.SWITCH_PIN) == level,
+                limit=self.HOME_LIMIT,
+            )
+            motion.wait()
+            if not motion.result:
+                raise Exception("Feeder could not be homed")
+        if self.gpio.input(self.SWITCH_PIN) != self.gpio.HIGH:
+            raise Exception("Feeder is not lifted")
+
+    def _lowered(self, motion: ActionHandle, duration: float):
+        if motion.result is None:
+            self._fail()
+        elif self._handle.cancelled():
+            self._start_raise()
+        else:
+            self._raise_timer = self.scheduler.call_later(duration, self._start_raise)
+
+    def _start_raise(self):
+        self._motion = self._move(
+            self.Direction.LIFT_FEED,
+            steps=self.LIFT_PHASES,
+            until=lambda: self.gpio.input(self.SWITCH_PIN) == self.gpio.LOW,
+        )
+        self._motion.add_done_callback(self._raised)
+
+    def _raised(self, motion: ActionHandle):
+        if motion.result is None:
+            self._fail()
+            return
+        self.state = self.State.IDLE
+        self._handle._finish(not self._handle.cancelled())
+
+    def _cancel(self):
+        # Cut the feed short: stop lowering or drinking and lift the feeder now
+        if self._raise_timer is None:
+            self._motion.cancel() # _lowered then starts the raise
+        elif self._raise_timer.cancel():
+            self._start_raise()
+
+    def _fail(self):
+        print("Error moving feeder")
+        self._handle._finish(False)
 
     def cleanup(self):
-        while self.state == self.State.FEEDING:
-            time.sleep(0.1)
-        # GPIO.cleanup()
+        if self._handle:
+            self._handle.wait()
+        # self.gpio.cleanup()
+
+    def feed(self, duration: int) -> ActionHandle:
+        if self.state != self.State.IDLE:
+            return ActionHandle.completed(False)
+        self.state = self.State.FEEDING
+        self._raise_timer = None
+        self._handle = ActionHandle(on_cancel=self._cancel)
+        self._motion = self._move(
+            self.Direction.LOWER_FEED,
+            until=lambda: self.gpio.input(self.SWITCH_PIN) == self.gpio.HIGH,
+        )
+        self._motion.add_done_callback(lambda motion: self._lowered(motion, duration))
+        return self._handle
+
+class ToneSequence:
+
+    SWEEP_STEP = 0.01 # seconds between frequency updates in a sweep
+
+    def __init__(self, segments: list, repeat: int = 1):
+        # segments are dicts with kind ("tone", "sweep" or "gap"), frequency, end_frequency
+        # and duration. Precomputed into steps of (offset, frequency, edge), where frequency
+        # 0 is silence and edge is ("on", frequency, duration, first of its repeat),
+        # ("off", frequency) or None.
+        self.steps = []
+        t = 0.0
+        for _ in range(repeat):
+            first = True
+            for segment in segments:
+                duration = segment["duration"]
+                if segment["kind"] == "gap" or duration <= 0:
+                    self.steps.append((t, 0, None))
+                    t += duration
+                    continue
+                start_frequency = segment["frequency"]
+                end_frequency = segment["end_frequency"] if segment["kind"] == "sweep" else start_frequency
+                n = max(1, math.ceil(duration / self.SWEEP_STEP)) if end_frequency != start_frequency else 1
+                for i in range(n):
+                    # Logarithmic, so every octave takes the same time
+                    frequency = start_frequency * (end_frequency / start_frequency) ** (i / n)
+                    edge = ("on", start_frequency, duration, first) if i == 0 else None
+                    self.steps.append((t + duration * i / n, frequency, edge))
+                first = False
+                t += duration
+                self.steps.append((t, 0, ("off", end_frequency)))
+        self.steps.append((t, 0, None))
+        self.duration = t
+
+    @classmethod
+    def tone(cls, duration: float, frequency: float) -> "ToneSequence":
+        return cls([{"kind": "tone", "frequency": frequency, "end_frequency": frequency, "duration": duration}])
 
-    def feed(self, duration: int) -> bool:
-        try:
-            if self.state == self.State.IDLE:
-                self.state = self.State.FEEDING
-                self._lower_feeder()
-                time.sleep(duration)
-                self._raise_feeder()
-                self.state = self.State.IDLE
-                return True
-            else:
-                return False
-        except Exception as e:
-            return False
 
 class Speaker:
 
     SPEAKER_PIN = 21
     SPEAKER_LED = 7
-
-    def __init__(self):
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.SPEAKER_PIN, GPIO.OUT)
-        GPIO.setup(self.SPEAKER_LED, GPIO.OUT)
-        GPIO.output(self.SPEAKER_LED, GPIO.LOW)
-
-    def play(self, duration: int, frequency: int) -> bool:
-        try:
-            GPIO.output(self.SPEAKER_LED, GPIO.HIGH)
-            pwm = GPIO.PWM(self.SPEAKER_PIN, frequency)
-            pwm.start(50)
-            time.sleep(duration)
-            pwm.stop()
-            GPIO.output(self.SPEAKER_LED, GPIO.LOW)
-            return True
-        except Exception as e:
-            print(e)
-            return False
+    DUTY_CYCLE = 50
+    IDLE_FREQUENCY = 1000 # the PWM keeps running between sounds; a 0% duty cycle silences it
+
+    def __init__(self, gpio, scheduler: Scheduler, pin: int = None, led: int = None):
+        self.gpio = gpio
+        self.gpio.setmode(self.gpio.BCM)
+        if pin is not None:
+            self.SPEAKER_PIN = pin
+        if led is not None:
+            self.SPEAKER_LED = led
+        self.gpio.setup(self.SPEAKER_PIN, self.gpio.OUT)
+        self.gpio.setup(self.SPEAKER_LED, self.gpio.OUT)
+        self.gpio.output(self.SPEAKER_LED, self.gpio.LOW)
+        self.scheduler = scheduler
+        self.pwm = self.gpio.PWM(self.SPEAKER_PIN, self.IDLE_FREQUENCY)
+        self.pwm.start(0)
+        self._pwm_frequency = self.IDLE_FREQUENCY
+        self._frequency = 0
+        self._handle = None # sequence currently playing
+        self._lock = threading.Lock()
+        self.lateness = Histogram("tone_step_lateness")
+
+    def _set(self, frequency: float):
+        # Called with _lock held
+        if frequency:
+            if frequency != self._pwm_frequency:
+                self.pwm.ChangeFrequency(frequency)
+                self._pwm_frequency = frequency
+            if not self._frequency:
+                self.pwm.ChangeDutyCycle(self.DUTY_CYCLE)
+                self.gpio.output(self.SPEAKER_LED, self.gpio.HIGH)
+        elif self._frequency:
+            self.pwm.ChangeDutyCycle(0)
+            self.gpio.output(self.SPEAKER_LED, self.gpio.LOW)
+        self._frequency = frequency
+
+    def play(self, duration: int, frequency: int, on_edge=None) -> ActionHandle:
+        return self.play_sequence(ToneSequence.tone(duration, frequency), on_edge)
+
+    def play_sequence(self, sequence: ToneSequence, on_edge=None) -> ActionHandle:
+        # Starts right away and replaces whatever is playing. on_edge(edge) runs as each
+        # segment actually starts and stops. Result is True when the sequence completes,
+        # False when cancelled or replaced and None on a GPIO error.
+        steps = sequence.steps
+        sounding = [None] # frequency of the segment that is on, for the off edge on cancel
+
+        def finish(result):
+            # Called with _lock held
+            if self._handle is handle:
+                self._handle = None
+                try:
+                    self._set(0)
+                except Exception as e:
+                    print(e)
+                    result = None
+            if sounding[0] is not None and on_edge:
+                on_edge(("off", sounding[0]))
+            sounding[0] = None
+            handle._finish(result)
+
+        def cancel():
+            with self._lock:
+                finish(False)
+
+        handle = ActionHandle(on_cancel=cancel)
+
+        def tick(i, start):
+            with self._lock:
+                if handle.done():
+                    return
+                offset = steps[i][0]
+                self.lateness.observe(max(0, self.scheduler.clock.monotonic() - (start + offset)))
+                try:
+                    # Steps due at the same offset, e.g. one tone ending as the next begins, go out together
+                    while i < len(steps) and steps[i][0] <= offset:
+                        _, frequency, edge = steps[i]
+                        self._set(frequency)
+                        if edge:
+                            sounding[0] = edge[1] if edge[0] == "on" else None
+                            if on_edge:
+                                on_edge(edge)
+                        i += 1
+                except Exception as e:
+                    print(f"Error playing tone: {e}")
+                    finish(None)
+                    return
+                if i == len(steps):
+                    finish(True)
+                    return
+            # Offsets are from the start of the sequence, so timing does not drift
+            self.scheduler.call_at(start + steps[i][0], tick, i, start)
+
+        with self._lock:
+            previous, self._handle = self._handle, handle
+        if previous:
+            previous.cancel()
+        now = self.scheduler.clock.monotonic()
+        self.scheduler.call_at(now, tick, 0, now)
+        return handle
 
     def cleanup(self):
-        GPIO.output(self.SPEAKER_LED, GPIO.LOW)
-        # GPIO.cleanup()
+        with self._lock:
+            handle = self._handle
+        if handle:
+            handle.cancel()
+        self.pwm.stop()
+        self.gpio.output(self.SPEAKER_LED, self.gpio.LOW)
+        # self.gpio.cleanup()
@@ -0,0 +1,115 @@
+# dispatch.py
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from lifecycle import RunLifecycle
+from metrics import Histogram, REGISTRY
+
+
+class ToolDispatcher:
+
+    # Devices each tool occupies. Calls on different devices overlap; calls sharing
+    # a device run one after another in the order the model asked for them.
+    DEVICES = {
+        "feed": ("feeder",),
+        "play_sound": ("speaker",),
+        "play_pattern": ("speaker",),
+        "wait_for_lever": ("levers",),
+        "run_trials": ("feeder", "levers", "speaker"),
+        "get_stats": (),
+        "get_human_help": ("human",),
+        "get_reasoning_help": ("reasoning",),
+    }
+    # Calls that wait for every call before them and that every call after them waits
+    # for, so several delays add up and a delay separates what comes before and after
+    BARRIERS = ("delay",)
+
+    def __init__(self, functions: dict, lifecycle: RunLifecycle = None, max_workers: int = 8, labels: dict = None):
+        self.functions = functions
+        self.lifecycle = lifecycle
+        self.labels = labels or {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+
+    def dispatch(self, tool_calls: list, deadline: float = None) -> list:
+        # tool_calls is a list of (name, json arguments); returns the outputs in the same order.
+        # Waits that would still be running at the deadline (time.monotonic()) are cut short
+        futures = self._schedule(
+            tool_calls, lambda name, arguments, after: self.executor.submit(self._call, name, arguments, after, deadline)
+        )
+        # The executor starts tasks in submission order, so a call's predecessors are
+        # always already running when it starts waiting on them
+        return [f.result() for f in futures]
+
+    def _schedule(self, tool_calls: list, start) -> list:
+        # start(name, arguments, after) launches one call once the calls in `after` are done
+        tails = {} # device -> the last call queued on it
+        barrier = None # the last barrier call
+        futures = []
+        for name, arguments in tool_calls:
+            if name in self.BARRIERS:
+                future = start(name, arguments, list(futures))
+                tails = {}
+                barrier = future
+            else:
+                devices = self.DEVICES.get(name, (name,))
+                # A device's previous call already waits for the barrier
+                after = [tails[d] for d in devices if d in tails] or ([barrier] if barrier else [])
+                future = start(name, arguments, after)
+                for d in devices:
+                    tails[d] = future
+            futures.append(future)
+        return futures
+
+    def _call(self, name: str, arguments: str, after: list, deadline: float) -> str:
+        wait(after)
+        arguments, note = self._arguments(name, arguments, deadline)
+        start = time.monotonic()
+        output = str(self.functions[name](**arguments))
+        self._timer(name).observe(time.monotonic() - start)
+        return f"{output} {note}" if note else output
+
+    def _timer(self, name: str) -> Histogram:
+        return REGISTRY.histogram(
+            "biotica_tool_seconds", "Wall time of each tool call", Histogram.DURATION_BUCKETS, tool=name, **self.labels
+        )
+
+    def _arguments(self, name: str, arguments: str, deadline: float) -> tuple:
+        arguments = json.loads(arguments)
+        if self.lifecycle:
+            # Sized when the call actually starts, after whatever ran before it on its devices
+            return self.lifecycle.fit(name, arguments, deadline)
+        return arguments, None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncToolDispatcher(ToolDispatcher):
+
+    # Same ordering rules, with coroutine functions run as tasks on the event loop
+
+    def __init__(self, functions: dict, lifecycle: RunLifecycle = None, labels: dict = None):
+        self.functions = functions
+        self.lifecycle = lifecycle
+        self.labels = labels or {}
+
+    async def dispatch(self, tool_calls: list, deadline: float = None) -> list:
+        tasks = self._schedule(
+            tool_calls, lambda name, arguments, after: asyncio.ensure_future(self._call(name, arguments, after, deadline))
+        )
+        # Cancelling the dispatch cancels every call still running
+        return await asyncio.gather(*tasks)
+
+    async def _call(self, name: str, arguments: str, after: list, deadline: float) -> str:
+        if after:
+            await asyncio.wait(after)
+        arguments, note = self._arguments(name, arguments, deadline)
+        start = time.monotonic()
+        output = str(await self.functions[name](**arguments))
+        self._timer(name).observe(time.monotonic() - start)
+        return f"{output} {note}" if note else output
+
+    def shutdown(self):
+        pass
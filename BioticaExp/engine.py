@@ -1,18 +1,27 @@
 
 from controller import MainController
+import openai
 from openai import OpenAI
 from typing_extensions import override
 from openai import AssistantEventHandler
 from tools import tools
-
-import requests
+from telemetry import LogSink
+from messages import MessageCursor
+from clock import Clock, get_clock
+from dispatch import ToolDispatcher
+from compaction import ThreadCompactor
+from session import SessionManifest
+from lifecycle import RunLifecycle
+from metrics import Histogram, REGISTRY
+from replay import http_client
 
 import time
 from datetime import datetime
-import json
 import os
 import logging
 import threading
+import selectors
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from dotenv import load_dotenv
 
@@ -39,38 +48,58 @@ class TrainingAgent:
             self.agent = agent
         @override
         def on_event(self, event):
+            self.agent._first_token(event)
             if self.agent.interrupt_pipe_data:
                 return
             self.agent._log({"status": str(event.event)})
-            thread_messages = self.agent.client.beta.threads.messages.list(self.agent.thread.id, run_id=event.data.id)
-            for message in thread_messages.data:
-                self.agent._log({"messages": str(message.content)})
             # Retrieve events that are denoted with 'requires_action'
             # since these will have our tool_calls
             if event.event == 'thread.run.requires_action':
                 run_id = event.data.id  # Retrieve the run ID from the event data
                 self.handle_requires_action(event.data, run_id)
 
+        @override
+        def on_message_done(self, message):
+            # Messages are assembled from the stream deltas, so no extra API call is needed
+            if self.agent.message_cursor.observe(message):
+                self.agent._log({"messages": str(message.content)})
+                self.agent.compactor.observe(str(message.content))
+
         def handle_requires_action(self, data, run_id):
-            tool_outputs = []
-            for tool in data.required_action.submit_tool_outputs.tool_calls:
+            tool_calls = data.required_action.submit_tool_outputs.tool_calls
+            for tool in tool_calls:
                 self.agent._log({"tool_calls": str(tool)})
-                tool_outputs.append({
-                    "tool_call_id": tool.id,
-                    "output": str(self.agent.function_call_switch[tool.function.name](**json.loads(tool.function.arguments)))
-                })
-      
+            # Calls on different devices run concurrently; outputs come back in call order.
+            # Long waits are cut short so the outputs still reach this run before it expires
+            outputs = self.agent.dispatcher.dispatch(
+                [(tool.function.name, tool.function.arguments) for tool in tool_calls],
+                deadline=self.agent.lifecycle.deadline(data),
+            )
+            tool_outputs = [
+                {"tool_call_id": tool.id, "output": output}
+                for tool, output in zip(tool_calls, outputs)
+            ]
+            for tool, output in zip(tool_calls, outputs):
+                self.agent.compactor.observe_tool_result(tool.function.name, tool.function.arguments, output)
+
             self.agent._log({"tool_outputs": str(tool_outputs)})
             # Submit all tool_outputs at the same time
-            self.submit_tool_outputs(tool_outputs, run_id)
+            self.submit_tool_outputs(tool_outputs, run_id, tool_calls)
 
-        def submit_tool_outputs(self, tool_outputs, run_id):
+        def submit_tool_outputs(self, tool_outputs, run_id, tool_calls):
             # Use the submit_tool_outputs_stream helper
             run = self.agent.client.beta.threads.runs.retrieve(
                 thread_id=self.current_run.thread_id, 
                 run_id=self.current_run.id
             )
-            if run.status != 'expired':
+            if run.status != 'requires_action':
+                # The run expired or was cancelled while the tools ran; hand the results to the next run
+                print(f"run {run.status}! keeping {len(tool_outputs)} tool outputs for the next run")
+                self.agent._log({"run_lost": run.status, "tool_outputs": str(tool_outputs)})
+                self.agent._run_lost(run.status)
+                self.agent.lifecycle.keep(tool_calls, [output["output"] for output in tool_outputs])
+                return
+            try:
                 with self.agent.client.beta.threads.runs.submit_tool_outputs_stream(
                     thread_id=self.current_run.thread_id,
                     run_id=self.current_run.id,
@@ -79,9 +108,11 @@ class TrainingAgent:
                 ) as stream:
                     for _ in stream.text_deltas:
                         pass
-            else:
-                print("run expired!")
-                pass
+            except openai.BadRequestError as e:
+                # Expired between the check and the submit
+                print(f"Error submitting tool outputs: {e}")
+                self.agent._run_lost("rejected")
+                self.agent.lifecycle.keep(tool_calls, [output["output"] for output in tool_outputs])
 
 
 
@@ -89,13 +120,17 @@ class TrainingAgent:
         "You are an intelligent agent that has access to a mouse habitat. Inside the habitat, there are two mice, two levers, two mice, a speaker, and a water dispenser.\n"
         "You can control the water dispenser which provides the two mice with access to water. You can control how for how long the mice have access by passing a value in seconds to the feed function \n"
         "You can also create sounds of different frequencies with the speaker. You can do this by passing a frequency to the play_sound function. One lever is on the right side of the cage and the other is on the left side.\n"
+        "For cues made of several tones, sweeps and gaps, call play_pattern with the whole pattern. It returns as soon as the pattern starts, so you can wait for the lever while it plays.\n"
         "When a mouse is on the lever, or under it, then the lever is pressed. You have access to a function that informs you when a lever is pressed called wait_for_lever. "
         "When you call this function, the levers are monitored for the specified duration. "
         "If the left lever is pressed by the mouse, the function returns 0; if the right lever is pressed, it returns 1; if neither lever is pressed during that time, the function returns -1.\n"
         "You can wait for the lever to be pressed for up to 2 minutes from a single call but you can call this function multiple times to wait for longer durations.\n"
         # "If you need help you have two ways of getting it. The first is a function called get_reasoning_help, where you can pass in a request as a string, and receive a response from a much smarter artificial intelligence model. "
         "You can call this function once every hour. \n"
-        "If you need help you can call a function called get_human_help, where you can pass in a request as a string and receive a response from a human. You can call this function only once every 1 hour it or it will be disabled.\n"
+        "If you need help you can call a function called get_human_help, where you can pass in a request as a string and receive a response from a human. You can call this function only once every 1 hour it or it will be disabled. "
+        "A human may not be available right away; if nobody answers within 2 minutes you get a ticket number and keep working, and the answer is sent to you as a message later.\n"
+        "To run many identical trials (tone, wait for a lever press, water for a rewarded press, pause) call run_trials, which runs the whole block locally and returns one summary. This is much faster than calling the other functions once per trial.\n"
+        "Call get_stats for an up-to-date summary of press rates, tone-to-press latencies, hit rates after rewards and the learning curve so far.\n"
         "Finally you wait for time to pass by passing the number of seconds you would like to wait for into the delay function. The maximum duration is 3 minutes, but you can call this function multiple times to delay for longer durations.\n"
         "Your job is to train the mice to press the lever.\n"
         "You can only exit the program once you are confident that the mice are trained successfully."
@@ -108,89 +143,278 @@ class TrainingAgent:
     )
 
 
-    def __init__(self):
-        self.lever_status = "idle"
-        self.client = OpenAI()
-        self.controller = MainController(client=self.client, engine=self)
-        self.assistant = self.client.beta.assistants.create(
-            instructions=self.ASSISTANT_PROMPT,
-            name="Mouse Trainer",
-            tools=tools,
-            model="gpt-4o",
+    SETUP_RETRY_MAX = 60 # longest wait, in seconds, between attempts to reach the API at start-up
+
+    def __init__(
+        self,
+        clock: Clock = None,
+        client: OpenAI = None,
+        name: str = None,
+        data_dir: str = ".",
+        pins: dict = None,
+        log_sink: LogSink = None,
+        controller=None,
+        debounce: tuple = None,
+    ):
+        # name, data_dir, pins and debounce set up one cage of several; client and
+        # log_sink can be shared between the cages of one process. controller is a
+        # MainController, or a Future of one, when the hardware is brought up by the caller
+        self.name = name
+        self.clock = clock or get_clock()
+        self.client = client or OpenAI(http_client=http_client())
+        os.makedirs(data_dir, exist_ok=True)
+        self.logger = self._cage_logger(name, data_dir) if name else logging.getLogger()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="hardware") as executor:
+            # Feeder homing and the GPIO self-test run while the API round trips below do
+            if controller is None:
+                controller = executor.submit(
+                    MainController, clock=self.clock, pins=pins, data_dir=data_dir, name=name, debounce=debounce
+                )
+            self._setup_api_retrying(data_dir)
+            self.controller = controller.result() if isinstance(controller, Future) else controller
+        for problem in self.controller.problems:
+            self.logger.warning(f"self-test: {problem}")
+        self.labels = {"cage": name} if name else {}
+        self.ttft = REGISTRY.histogram(
+            "biotica_ttft_seconds", "Run start to the first message delta or tool call", Histogram.DURATION_BUCKETS, **self.labels
         )
-        self.thread = self.client.beta.threads.create()
-        self.message = self.client.beta.threads.messages.create(
-            thread_id=self.thread.id,
-            role="user",
-            content=self.THREAD_PROMPT,
+        self.lever_notify = REGISTRY.histogram(
+            "biotica_lever_notify_seconds", "Lever edge to the agent being notified of an unsolicited press", **self.labels
         )
+        self.runs_started = REGISTRY.counter("biotica_runs", "Runs started", **self.labels)
+        self._run_started = None
 
         self.function_call_switch = {
             "feed": self.controller.feed,
             "play_sound": self.controller.play_sound,
+            "play_pattern": self.controller.play_pattern,
             "wait_for_lever": self.controller.wait_for_lever,
             "delay": self.controller.delay,
             "get_human_help": self.controller.get_human_help,
             "get_reasoning_help": self.controller.get_reasoning_help,
+            "run_trials": self.controller.run_trials,
+            "get_stats": self.controller.get_stats,
         }
+        self.lifecycle = RunLifecycle(self.clock)
+        self.dispatcher = ToolDispatcher(self.function_call_switch, self.lifecycle, labels=self.labels)
 
         self.log_url = os.getenv("LOG_URL")
         self.api_key = os.getenv("API_KEY")
+        self._owns_log_sink = log_sink is None
+        self.log_sink = log_sink or LogSink(self.log_url, self.api_key, os.path.join(data_dir, "log_spool"), clock=self.clock)
 
-        logging.info(f"assistant id: {self.assistant.id}")
-        logging.info(f"thread id: {self.thread.id}")
-        self.interrupt_pipe = "/tmp/interrupt"
+        self.logger.info(f"assistant id: {self.assistant.id}")
+        self.logger.info(f"thread id: {self.thread.id}")
+        self.interrupt_pipe = "/tmp/interrupt" if name is None else f"/tmp/interrupt-{name}"
         self.interrupt_pipe_data = None
+        self._pending_interrupts = []
+        self._pending_presses = [0, 0]
+        self._interrupt_lock = threading.Lock()
+        self._pipe_fd = None
+        self._pipe_keepalive = None
+        self._pipe_closed = False
         self._initialize_pipe()
+        # Once interrupts can be taken; answers that came in during startup are delivered now
+        self.controller.attach(self, self.client)
         self.event_handler = self.EventHandler(self)
+        self._start_watchers()
+
+    def _setup_api_retrying(self, data_dir: str):
+        # The feeder may have homed already. Exiting would home it, and water the
+        # animals, again on every restart, so wait for e.g. the network to come up
+        delay = 1
+        while True:
+            try:
+                return self._setup_api(data_dir)
+            except (openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError) as e:
+                print(f"Error setting up the API, retrying in {delay} seconds: {e}")
+                self.logger.warning(f"API setup failed: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, self.SETUP_RETRY_MAX)
+
+    def _setup_api(self, data_dir: str):
+        # The assistant and thread, reused from session.json on a warm start
+        self.session = SessionManifest(os.path.join(data_dir, "session.json"))
+        self.assistant = self.session.assistant(
+            self.client,
+            instructions=self.ASSISTANT_PROMPT,
+            name="Mouse Trainer",
+            tools=tools,
+            model="gpt-4o",
+        )
+        self.thread, resumed = self.session.thread(self.client)
+        self.compactor = ThreadCompactor(self.client)
+        if resumed:
+            self.compactor.messages, self.compactor.chars = self.session.thread_size()
+            # A run left over from before the restart would block new runs. Always the
+            # blocking reset, also in subclasses that override it
+            TrainingAgent.reset(self)
+        else:
+            self.message = self.client.beta.threads.messages.create(
+                thread_id=self.thread.id,
+                role="user",
+                content=self.THREAD_PROMPT,
+            )
+            self.compactor.observe(self.THREAD_PROMPT)
+        self.message_cursor = MessageCursor(self.client, self.thread.id)
+
+    @staticmethod
+    def _cage_logger(name: str, data_dir: str) -> logging.Logger:
+        # Each cage gets its own agent.log next to its other files
+        logger = logging.getLogger(f"cage.{name}")
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        if not logger.handlers:
+            handler = logging.FileHandler(os.path.join(data_dir, "agent.log"))
+            handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S"))
+            logger.addHandler(handler)
+        return logger
+
+    def _start_watchers(self):
         self.pipe_thread = threading.Thread(target=self._update_pipe_data, daemon=True)
         self.pipe_thread.start()
+        self.lever_thread = threading.Thread(target=self._watch_lever_events, daemon=True)
+        self.lever_thread.start()
 
     def _initialize_pipe(self):
         if not os.path.exists(self.interrupt_pipe):
             os.mkfifo(self.interrupt_pipe)
 
+    def _open_pipe(self) -> int:
+        fd = os.open(self.interrupt_pipe, os.O_RDONLY | os.O_NONBLOCK)
+        # Holding our own write end open means the read end never sees EOF between writers
+        self._pipe_keepalive = os.open(self.interrupt_pipe, os.O_WRONLY | os.O_NONBLOCK)
+        self._pipe_fd = fd
+        return fd
+
+    def _close_pipe(self):
+        # Wakes the reader, which closes the read end once it sees _pipe_closed
+        self._pipe_closed = True
+        if self._pipe_keepalive is not None:
+            try:
+                os.write(self._pipe_keepalive, b"\n")
+            except OSError:
+                pass
+            os.close(self._pipe_keepalive)
+            self._pipe_keepalive = None
+
+    def _read_pipe(self, fd: int, buffer: bytes) -> bytes:
+        # Operator messages written to the FIFO, one per line; returns the unfinished tail
+        try:
+            buffer += os.read(fd, 4096)
+        except BlockingIOError:
+            return buffer
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                self._interrupt(line.decode(errors="replace").strip())
+        return buffer
+
     def _update_pipe_data(self):
+        fd = self._open_pipe()
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+        buffer = b""
+        while not self._pipe_closed:
+            selector.select()
+            buffer = self._read_pipe(fd, buffer)
+        selector.close()
+        os.close(fd)
+
+    def _watch_lever_events(self):
+        cursor = 0
+        ring = self.controller.lever_events
         while True:
-            logging.debug("update pipe data")
-            with open(self.interrupt_pipe, 'r') as pipe:
-                lines = pipe.readlines()
-                if lines:
-                    self.interrupt_pipe_data = lines[-1].strip()
+            ring.wait()
+            events, cursor, lost = ring.read(cursor)
+            self._lever_events(events, lost)
 
+    def _lever_events(self, events: list, lost: int):
+        if lost:
+            self.logger.warning(f"lost {lost} lever events")
+        for event in events:
+            if not event.waiting:
+                self.lever_notify.observe(self.clock.monotonic() - event.monotonic)
+                print(f"{['left', 'right'][event.lever]} lever interrupt")
+                with self._interrupt_lock:
+                    self._pending_presses[event.lever] += 1
+                    self._refresh_interrupt()
 
-    def write_to_pipe(self, data):
-        try:
-            with open(self.interrupt_pipe, 'w') as pipe:
-                pipe.write(data + "\n")
-        except Exception as e:
-            print(f"Error writing to pipe: {e}")
+    def _interrupt(self, message: str):
+        with self._interrupt_lock:
+            self._pending_interrupts.append(message)
+            self._refresh_interrupt()
+
+    def _refresh_interrupt(self):
+        # Called with _interrupt_lock held; a burst of presses becomes one line per lever
+        lines = list(self._pending_interrupts)
+        for lever, count in zip(["left", "right"], self._pending_presses):
+            if count:
+                times = "" if count == 1 else f" {count} times"
+                lines.append(f"The {lever} lever was recently pressed{times} by the mouse.")
+        self.interrupt_pipe_data = "\n".join(lines) or None
+
+    def _take_interrupts(self) -> str:
+        with self._interrupt_lock:
+            message = self.interrupt_pipe_data
+            self._pending_interrupts = []
+            self._pending_presses = [0, 0]
+            self.interrupt_pipe_data = None
+        return message
+
+    def _next_message(self) -> str:
+        interrupt = self._take_interrupts()
+        if interrupt:
+            print("*"*10, interrupt, "*"*10)
+            self.logger.info(interrupt)
+        # Results the previous run never received go in the same message as any interrupt
+        return "\n\n".join(filter(None, [self.lifecycle.take_message(), interrupt]))
+
+    FIRST_TOKEN_EVENTS = ("thread.message.delta", "thread.run.requires_action")
+
+    def _first_token(self, event):
+        if self._run_started is not None and event.event in self.FIRST_TOKEN_EVENTS:
+            self.ttft.observe(time.monotonic() - self._run_started)
+            self._run_started = None
+
+    def _run_lost(self, status: str):
+        REGISTRY.counter("biotica_runs_lost", "Runs that ended before their tool outputs were submitted", status=status, **self.labels).inc()
 
     def _log(self, data: dict):
-        logging.info(data)
-        payload = {
-            "data": data
-        }
-        headers = {
-            "Content-Type": "application/json",
-            "X-API-Key": self.api_key
-        }
+        if self.name:
+            data = {"cage": self.name, **data}
+        self.logger.info(data)
+        self.log_sink.log(data)
+
+
+    def _compact_thread(self):
+        # Swap a long thread for a fresh one seeded with a summary, so runs stay cheap
+        old_thread = self.thread
         try:
-            response = requests.post(self.log_url, json=payload, headers=headers)
+            self.thread, summary = self.compactor.compact(old_thread.id, self.THREAD_PROMPT, self.controller.get_stats())
         except Exception as e:
-            print(f"Error logging data: {e}")
-
+            print(f"Error compacting thread: {e}")
+            return
+        self.message_cursor = MessageCursor(self.client, self.thread.id)
+        self.session.set_thread(self.thread.id)
+        print(f"compacted thread {old_thread.id} into {self.thread.id}")
+        self.logger.info(f"thread id: {self.thread.id} (compacted from {old_thread.id})")
+        self._log({"compaction": {"old_thread": old_thread.id, "new_thread": self.thread.id, "summary": summary}})
 
     def train(self):
-        if self.interrupt_pipe_data:
-            print("*"*10, self.interrupt_pipe_data, "*"*10)
-            logging.info(self.interrupt_pipe_data)
+        if self.compactor.needs_compaction():
+            self._compact_thread()
+        self.session.set_thread_size(self.compactor.messages, self.compactor.chars)
+        content = self._next_message()
+        if content:
             self.client.beta.threads.messages.create(
                 thread_id=self.thread.id,
                 role="user",
-                content=self.interrupt_pipe_data
+                content=content
             )
-        self.interrupt_pipe_data = None
+            self.compactor.observe(content)
+        self.runs_started.inc()
+        self._run_started = time.monotonic()
         with self.client.beta.threads.runs.stream(
             thread_id=self.thread.id,
             assistant_id=self.assistant.id,
@@ -199,31 +423,59 @@ class TrainingAgent:
             for text in stream.text_deltas:
                 if self.interrupt_pipe_data:
                     break
+            run = stream.current_run
+        if run:
+            self._catch_up(run)
+
+    def _catch_up(self, run):
+        # Pick up anything the stream did not deliver, e.g. after an interrupt
+        try:
+            for message in self.message_cursor.catch_up(run.id):
+                self._log({"messages": str(message.content)})
+                self.compactor.observe(str(message.content))
+        except Exception as e:
+            print(f"Error fetching messages: {e}")
+
+    ACTIVE_RUN_STATUSES = ("queued", "in_progress", "requires_action", "cancelling")
 
     def reset(self):
+        # Cancel every active run at once and return when they have all stopped
         runs = self.client.beta.threads.runs.list(
             thread_id=self.thread.id
         )
-        for run in runs.data:
-            if run.status == "queued" or run.status == "in_progress" or run.status == "requires_action":
-                try:
-                    self.client.beta.threads.runs.cancel(
-                        thread_id=self.thread.id,
-                        run_id=run.id
-                    )
-                except Exception as e:
-                    print(f"Error cancelling run: {e}")
+        active = [run for run in runs.data if run.status in self.ACTIVE_RUN_STATUSES]
+        if active:
+            with ThreadPoolExecutor(max_workers=len(active)) as executor:
+                list(executor.map(self._cancel_run, active))
+
+    def _cancel_run(self, run):
+        if run.status != "cancelling":
+            try:
+                self.client.beta.threads.runs.cancel(
+                    thread_id=self.thread.id,
+                    run_id=run.id
+                )
+            except Exception as e:
+                print(f"Error cancelling run: {e}")
+        interval = 0.05
+        while True:
+            try:
                 check = self.client.beta.threads.runs.retrieve(
                     thread_id=self.thread.id,
                     run_id=run.id
                 )
-                while check.status == "cancelling":
-                    check = self.client.beta.threads.runs.retrieve(
-                        thread_id=self.thread.id,
-                        run_id=run.id
-                    )
-                    time.sleep(0.1)
+            except Exception as e:
+                print(f"Error checking run: {e}")
+                return
+            if check.status not in self.ACTIVE_RUN_STATUSES:
+                return
+            time.sleep(interval)
+            interval = min(interval * 2, 1)
 
     def cleanup(self):
+        self._close_pipe()
         os.remove(self.interrupt_pipe)
+        self.dispatcher.shutdown()
         self.controller.cleanup()
+        if self._owns_log_sink:
+            self.log_sink.close()
@@ -0,0 +1,163 @@
+# eventstore.py
+import math
+import mmap
+import os
+import struct
+import threading
+from enum import IntEnum
+
+
+class Device(IntEnum):
+    LEFT_LEVER = 0
+    RIGHT_LEVER = 1
+    FEEDER = 2
+    SPEAKER = 3
+
+
+class EventType(IntEnum):
+    PRESS = 1
+    RELEASE = 2
+    FEED_START = 3
+    FEED_END = 4
+    TONE_ON = 5
+    TONE_OFF = 6
+    HOME = 7 # the feeder homed at start-up; param1 is whether it ended up lifted
+
+
+class EventStore:
+
+    # File layout: a 16 byte header (magic, record count) followed by
+    # fixed 32 byte records (timestamp, device, event type, two parameters).
+    # Records are appended in time order, so a window is found by binary search.
+    MAGIC = b"BIOEVT01"
+    HEADER = struct.Struct("<8sQ")
+    RECORD = struct.Struct("<dHHxxxxdd")
+    GROW_RECORDS = 1 << 16 # file grows 2 MB at a time
+    CHUNK_RECORDS = 4096
+
+    def __init__(self, path: str = "events.bin"):
+        self.path = path
+        self._lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) < self.HEADER.size
+        self._file = open(path, "r+b" if not new else "w+b")
+        if new:
+            self._file.write(self.HEADER.pack(self.MAGIC, 0))
+            self._file.truncate(self.HEADER.size + self.GROW_RECORDS * self.RECORD.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.count = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            raise Exception(f"{path} is not an event store")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, timestamp: float, device: Device, event: EventType, param1: float = 0, param2: float = 0):
+        with self._lock:
+            offset = self.HEADER.size + self.count * self.RECORD.size
+            if offset + self.RECORD.size > len(self._map):
+                self._grow()
+            self.RECORD.pack_into(self._map, offset, timestamp, device, event, param1, param2)
+            self.count += 1
+            # The count is written after the record, so a reader never sees a half-written one
+            self.HEADER.pack_into(self._map, 0, self.MAGIC, self.count)
+
+    def _grow(self):
+        size = len(self._map) + self.GROW_RECORDS * self.RECORD.size
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def flush(self):
+        with self._lock:
+            self._map.flush()
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+
+    def _timestamp(self, i: int) -> float:
+        return struct.unpack_from("<d", self._map, self.HEADER.size + i * self.RECORD.size)[0]
+
+    def _bisect(self, timestamp: float) -> int:
+        # Index of the first record at or after timestamp
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, start: float = None, end: float = None, device: Device = None, event: EventType = None):
+        # Yields (timestamp, device, event, param1, param2) with start <= timestamp < end,
+        # reading CHUNK_RECORDS at a time so long windows stay cheap on memory
+        with self._lock:
+            first = 0 if start is None else self._bisect(start)
+            last = self.count if end is None else self._bisect(end)
+        for i in range(first, last, self.CHUNK_RECORDS):
+            with self._lock:
+                # Copied under the lock so _grow() can remap between chunks
+                chunk = self._map[self.HEADER.size + i * self.RECORD.size:self.HEADER.size + min(i + self.CHUNK_RECORDS, last) * self.RECORD.size]
+            for record in self.RECORD.iter_unpack(chunk):
+                if device is not None and record[1] != device:
+                    continue
+                if event is not None and record[2] != event:
+                    continue
+                yield record
+
+    def press_counts(self, start: float, end: float, window: float) -> list:
+        # Presses per lever in consecutive windows: [(window start, left, right), ...]
+        # The last window may be partial; a press exactly at `end` goes in it too
+        bins = [[start + i * window, 0, 0] for i in range(max(1, math.ceil((end - start) / window)))]
+        for timestamp, device, _, _, _ in self.records(start, end, event=EventType.PRESS):
+            i = min(int((timestamp - start) // window), len(bins) - 1)
+            bins[i][1 + device] += 1
+        return [tuple(b) for b in bins]
+
+    def inter_press_intervals(self, start: float = None, end: float = None, device: Device = None) -> list:
+        intervals = []
+        last = None
+        for timestamp, _, _, _, _ in self.records(start, end, device=device, event=EventType.PRESS):
+            if last is not None:
+                intervals.append(timestamp - last)
+            last = timestamp
+        return intervals
+
+    def reward_contingent_rate(self, start: float = None, end: float = None, window: float = 10) -> dict:
+        # Press rate in the `window` seconds after each feed, against the rate at other times
+        presses = after = rewards = 0
+        covered = 0.0
+        window_end = None
+        first = last = None
+        for timestamp, _, event, _, _ in self.records(start, end):
+            if first is None:
+                first = timestamp
+            last = timestamp
+            if event == EventType.FEED_START:
+                rewards += 1
+                # Merge overlapping windows so time is not counted twice
+                if window_end is None or timestamp > window_end:
+                    covered += window
+                else:
+                    covered += timestamp + window - window_end
+                window_end = timestamp + window
+            elif event == EventType.PRESS:
+                presses += 1
+                if window_end is not None and timestamp < window_end:
+                    after += 1
+        if first is None:
+            return {"after_reward": 0.0, "baseline": 0.0, "rewards": 0}
+        span_start = start if start is not None else first
+        span_end = end if end is not None else last
+        if window_end is not None and window_end > span_end:
+            covered -= window_end - span_end
+        baseline_time = span_end - span_start - covered
+        return {
+            "after_reward": after / covered if covered > 0 else 0.0,
+            "baseline": (presses - after) / baseline_time if baseline_time > 0 else 0.0,
+            "rewards": rewards,
+        }
@@ -0,0 +1,29 @@
+# hardware.py
+import os
+import sys
+
+from clock import get_clock
+
+_backend = None
+
+
+def get_backend():
+    # BIOTICA_HARDWARE=sim swaps RPi.GPIO for an in-process simulation
+    global _backend
+    if _backend is None:
+        if os.getenv("BIOTICA_HARDWARE", "gpio") == "sim":
+            from simulation import SimulatedGPIO
+            _backend = SimulatedGPIO(get_clock())
+        else:
+            import RPi.GPIO as GPIO
+            _backend = GPIO
+    return _backend
+
+
+def is_simulated(gpio) -> bool:
+    return getattr(gpio, "SIMULATED", False)
+
+
+def is_headless() -> bool:
+    # BIOTICA_HEADLESS=1, or no terminal to ask (e.g. started by systemd after a power cut)
+    return os.getenv("BIOTICA_HEADLESS") == "1" or not sys.stdin or not sys.stdin.isatty()
@@ -0,0 +1,137 @@
+# helpdesk.py
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+
+from clock import Clock, get_clock
+
+
+class HelpDesk:
+
+    # Help requests are spooled as one JSON file per ticket in <spool_dir>/open and
+    # answered by writing <spool_dir>/answers/<ticket>.json, usually with the CLI below:
+    #
+    #   python helpdesk.py list
+    #   python helpdesk.py answer <ticket> "Try a shorter tone"
+    #
+    # Answered tickets are moved to <spool_dir>/closed. An answer that arrives while
+    # nobody is waiting for it is handed to on_answer(ticket, request, answer).
+
+    POLL_INTERVAL = 1 # seconds between scans of the answers directory
+
+    def __init__(self, spool_dir: str = "help_spool", clock: Clock = None, on_answer=None):
+        self.spool_dir = spool_dir
+        self.clock = clock or get_clock()
+        self.on_answer = on_answer
+        for name in ("open", "answers", "closed"):
+            os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+        self._seq = itertools.count(1)
+        self._cond = threading.Condition()
+        self._waiting = {} # ticket -> answer, None until it arrives
+        self._running = True
+        self._thread = threading.Thread(target=self._watch, daemon=True, name="help-desk")
+        self._thread.start()
+
+    def _path(self, folder: str, ticket: str) -> str:
+        return os.path.join(self.spool_dir, folder, ticket + ".json")
+
+    @staticmethod
+    def _write(path: str, data: dict):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def ask(self, request: str) -> str:
+        ticket = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._seq)}"
+        self._write(self._path("open", ticket), {"ticket": ticket, "request": request, "asked_at": self.clock.time()})
+        print(f"help requested (ticket {ticket}): {request}")
+        print(f"answer with: python helpdesk.py answer {ticket} \"...\"")
+        return ticket
+
+    def wait(self, ticket: str, timeout: float) -> str:
+        # Returns the answer, or None if none came within timeout seconds (experiment clock).
+        # A late answer then goes to on_answer instead
+        with self._cond:
+            self._waiting[ticket] = None
+            try:
+                self._cond.wait_for(lambda: self._waiting[ticket] is not None, timeout=self.clock.timeout(timeout))
+                return self._waiting[ticket]
+            finally:
+                del self._waiting[ticket]
+
+    def _watch(self):
+        folder = os.path.join(self.spool_dir, "answers")
+        while self._running:
+            for name in sorted(os.listdir(folder)):
+                if name.endswith(".json"):
+                    self._close(name[:-len(".json")])
+            time.sleep(self.POLL_INTERVAL)
+
+    def _close(self, ticket: str):
+        try:
+            with open(self._path("answers", ticket)) as f:
+                answer = json.load(f)["answer"]
+            with open(self._path("open", ticket)) as f:
+                record = json.load(f)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring help answer {ticket}: {e}")
+            try:
+                os.replace(self._path("answers", ticket), self._path("closed", ticket + ".invalid"))
+            except OSError as e:
+                # e.g. the CLI moved or removed it meanwhile; the watcher thread must keep going
+                print(f"Error setting aside help answer {ticket}: {e}")
+            return
+        record.update(answer=answer, answered_at=self.clock.time())
+        self._write(self._path("closed", ticket), record)
+        for folder in ("answers", "open"):
+            try:
+                os.remove(self._path(folder, ticket))
+            except OSError as e:
+                print(f"Error removing {folder} help file {ticket}: {e}")
+        print(f"human response ({ticket}): {answer}")
+        with self._cond:
+            if ticket in self._waiting:
+                self._waiting[ticket] = answer
+                self._cond.notify_all()
+                return
+        if self.on_answer:
+            self.on_answer(ticket, record["request"], answer)
+
+    def close(self):
+        self._running = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer help requests from the training agent")
+    parser.add_argument("--spool-dir", default="help_spool")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="show open requests")
+    answer = commands.add_parser("answer", help="answer an open request")
+    answer.add_argument("ticket")
+    answer.add_argument("answer")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        folder = os.path.join(args.spool_dir, "open")
+        names = sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+        for name in names:
+            if name.endswith(".json"):
+                with open(os.path.join(folder, name)) as f:
+                    record = json.load(f)
+                asked_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["asked_at"]))
+                print(f"{record['ticket']}  {asked_at}\n    {record['request']}\n")
+        if not names:
+            print("no open requests")
+    else:
+        if not os.path.exists(os.path.join(args.spool_dir, "open", args.ticket + ".json")):
+            parser.error(f"no open request {args.ticket}")
+        HelpDesk._write(os.path.join(args.spool_dir, "answers", args.ticket + ".json"), {"answer": args.answer})
+        print(f"answered {args.ticket}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# levers.py
+import itertools
+import threading
+from collections import namedtuple
+
+LeverEvent = namedtuple("LeverEvent", ["seq", "lever", "timestamp", "monotonic", "waiting"])
+
+
+class LeverEventRing:
+
+    # Single-writer ring of timestamped lever events. append() never blocks: the
+    # sequence counter and the slot store are each atomic under the GIL, so the GPIO
+    # callback thread only ever does a couple of list operations. Readers keep their
+    # own cursor and are told how many events they missed if they fall a lap behind.
+
+    def __init__(self, size: int = 4096):
+        self._size = size
+        self._buffer = [None] * size
+        self._seq = itertools.count()
+        self._signal = threading.Event()
+        self._listeners = []
+
+    def append(self, lever: int, timestamp: float, monotonic: float, waiting: bool) -> LeverEvent:
+        seq = next(self._seq)
+        event = LeverEvent(seq, lever, timestamp, monotonic, waiting)
+        self._buffer[seq % self._size] = event
+        self._signal.set()
+        for fn in self._listeners:
+            fn()
+        return event
+
+    def add_listener(self, fn):
+        # fn() is called on the writer's thread after each append, so it must not block;
+        # for readers that are woken some other way than wait(), e.g. an event loop
+        self._listeners.append(fn)
+
+    def read(self, cursor: int) -> tuple:
+        # Returns (events since cursor, new cursor, events lost to overrun)
+        events = []
+        lost = 0
+        while True:
+            event = self._buffer[cursor % self._size]
+            if event is None or event.seq < cursor:
+                break # not written yet
+            if event.seq > cursor:
+                # The writer lapped us; skip to the oldest event still in the ring
+                oldest = event.seq - self._size + 1
+                lost += oldest - cursor
+                cursor = oldest
+                continue
+            events.append(event)
+            cursor += 1
+        return events, cursor, lost
+
+    def wait(self, timeout: float = None) -> bool:
+        # Blocks until something is appended; readers then call read()
+        signalled = self._signal.wait(timeout)
+        self._signal.clear()
+        return signalled
+
+
+class LeverInput:
+
+    # Debounced press/release tracking for one active-low lever switch watched on
+    # both edges. Every edge callback flips the state, so a press and release that
+    # both land before the callback thread gets to them are still counted. Edges
+    # closer than `debounce` seconds to the last accepted one are contact bounce;
+    # once the line has had time to settle its level is read to resync the state.
+
+    def __init__(self, gpio, pin: int, scheduler, debounce: float, on_press, on_release):
+        self.gpio = gpio
+        self.pin = pin
+        self.scheduler = scheduler
+        self.clock = scheduler.clock
+        self.debounce = debounce
+        self.on_press = on_press # on_press(monotonic time of the edge)
+        self.on_release = on_release # on_release(monotonic time of the edge, hold duration)
+        self.pressed = gpio.input(pin) == gpio.LOW
+        self.pressed_at = None
+        self._last_edge = float("-inf")
+        self._bounced_at = None # last edge ignored as bounce
+        self._settle = None
+        self._lock = threading.Lock()
+
+    def edge(self, channel):
+        # GPIO callback; the time is taken before anything else
+        now = self.clock.monotonic()
+        with self._lock:
+            if now - self._last_edge < self.debounce:
+                self._bounced_at = now
+                if self._settle is None:
+                    self._settle = self.scheduler.call_at(self._last_edge + self.debounce, self._resync)
+                return
+            self._transition(not self.pressed, now)
+
+    def _resync(self):
+        with self._lock:
+            self._settle = None
+            pressed = self.gpio.input(self.pin) == self.gpio.LOW
+            if pressed != self.pressed:
+                # The last bounce is when the contact actually came to rest
+                self._transition(pressed, self._bounced_at)
+            self._bounced_at = None
+
+    def _transition(self, pressed: bool, now: float):
+        # Called with _lock held, so presses and releases are reported in order
+        self.pressed = pressed
+        self._last_edge = now
+        if pressed:
+            self.pressed_at = now
+            self.on_press(now)
+        elif self.pressed_at is not None:
+            self.on_release(now, now - self.pressed_at)
@@ -0,0 +1,55 @@
+# lifecycle.py
+import threading
+import time
+
+from clock import Clock
+
+
+class RunLifecycle:
+
+    SUBMIT_MARGIN = 20 # seconds kept free before a run expires to submit its tool outputs
+    SPLITTABLE = ("wait_for_lever", "delay") # tools that can stop early and be called again
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self._orphaned = []
+        self._lock = threading.Lock()
+
+    def deadline(self, run) -> float:
+        # Latest time.monotonic() by which tool outputs should be ready for this run
+        if not getattr(run, "expires_at", None):
+            return None
+        return time.monotonic() + (run.expires_at - time.time()) - self.SUBMIT_MARGIN
+
+    def fit(self, name: str, arguments: dict, deadline: float) -> tuple:
+        # Shortens a wait that would outlive the run. Returns (arguments, note for the output)
+        if deadline is None or name not in self.SPLITTABLE:
+            return arguments, None
+        # Durations are on the experiment clock, the deadline is in real seconds
+        budget = max(0, (deadline - time.monotonic()) / self.clock.timeout(1))
+        requested = arguments.get("duration", 0)
+        if requested <= budget:
+            return arguments, None
+        note = (
+            f"(ran for {budget:.0f} of the {requested:.0f} seconds requested; it was cut short so the result "
+            "reaches you before this run expires, call it again to continue)"
+        )
+        return {**arguments, "duration": budget}, note
+
+    def keep(self, tool_calls: list, outputs: list):
+        # Results of work that finished after its run was gone
+        with self._lock:
+            for tool, output in zip(tool_calls, outputs):
+                self._orphaned.append((tool.function.name, tool.function.arguments, output))
+
+    def take_message(self) -> str:
+        with self._lock:
+            orphaned, self._orphaned = self._orphaned, []
+        if not orphaned:
+            return None
+        lines = [f"- {name}({arguments}) returned {output}" for name, arguments, output in orphaned]
+        return (
+            "Your previous run ended before these function results could be delivered. "
+            "The actions were carried out, so do not repeat them just because you did not see the results:\n"
+            + "\n".join(lines)
+        )
@@ -1,11 +1,67 @@
 # main.py
-from engine import TrainingAgent
+from dotenv import load_dotenv
+load_dotenv() # before anything reads BIOTICA_* settings
+
+import hardware
+import asyncio
+import os
 import threading
 import queue
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+def start_metrics():
+    # BIOTICA_METRICS_PORT=0 turns the OpenMetrics endpoint off
+    port = int(os.getenv("BIOTICA_METRICS_PORT", "9108"))
+    if not port:
+        return None
+    from metrics import MetricsExporter
+    try:
+        return MetricsExporter(port=port)
+    except OSError as e:
+        print(f"Metrics endpoint not started: {e}")
+        return None
+
+def stop_metrics(exporter):
+    if exporter:
+        exporter.close()
+
+def start_agent(use_async: bool = False):
+    # Cold start: the hardware comes up on its own thread, so feeder homing and the
+    # GPIO self-test overlap importing openai and setting up the assistant and thread
+    from controller import MainController
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="hardware") as executor:
+        controller = executor.submit(MainController)
+        if use_async:
+            from async_engine import AsyncTrainingAgent as Agent
+        else:
+            from engine import TrainingAgent as Agent
+        return Agent(controller=controller)
+
+def _start_habitat(agent):
+    if not hardware.is_simulated(agent.controller.gpio):
+        return None
+    from simulation import Habitat
+    habitat = Habitat(agent.controller.gpio, agent.controller)
+    habitat.start()
+    return habitat
+
+def _stop_habitat(habitat):
+    if habitat:
+        habitat.stop()
+        print(f"simulated habitat: {habitat.summary()}")
 
 def main():
-    agent = TrainingAgent()
+    # BIOTICA_ENGINE=async runs the agent on an asyncio event loop
+    if os.getenv("BIOTICA_ENGINE", "sync") == "async":
+        asyncio.run(async_main())
+        return
+
+    started = time.monotonic()
+    agent = start_agent()
+    print(f"ready in {time.monotonic() - started:.1f}s")
+    habitat = _start_habitat(agent)
+    exporter = start_metrics()
 
     print(f"assistant id: {agent.assistant.id}")
     print(f"thread id: {agent.thread.id}")
@@ -17,11 +73,37 @@ def main():
             i += 1
             agent.train()
             print("Agent killed, restarting...\n")
-            agent.reset()
-            time.sleep(3)
+            agent.reset() # returns once the interrupted runs have actually stopped
+    finally:
+        print("Cleaning up...")
+        _stop_habitat(habitat)
+        agent.cleanup()
+        stop_metrics(exporter)
+
+async def async_main():
+    started = time.monotonic()
+    agent = start_agent(use_async=True)
+    await agent.start()
+    print(f"ready in {time.monotonic() - started:.1f}s")
+    habitat = _start_habitat(agent)
+    exporter = start_metrics()
+
+    print(f"assistant id: {agent.assistant.id}")
+    print(f"thread id: {agent.thread.id}")
+
+    i = 0
+    try:
+        while True:
+            print("*"*10, i, "*"*10)
+            i += 1
+            await agent.train()
+            print("Agent killed, restarting...\n")
+            await agent.reset()
     finally:
         print("Cleaning up...")
+        _stop_habitat(habitat)
         agent.cleanup()
+        stop_metrics(exporter)
 
 if __name__ == "__main__":
     main()
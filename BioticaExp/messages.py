@@ -0,0 +1,34 @@
+# messages.py
+from collections import OrderedDict
+
+from openai import OpenAI
+
+
+class MessageCursor:
+
+    MAX_SEEN = 1000
+
+    def __init__(self, client: OpenAI, thread_id: str):
+        self.client = client
+        self.thread_id = thread_id
+        self._last_seen = {} # run id -> id of the newest message seen for that run
+        self._seen = OrderedDict()
+
+    def observe(self, message) -> bool:
+        # Returns False if the message was already seen
+        if message.id in self._seen:
+            return False
+        self._seen[message.id] = True
+        if len(self._seen) > self.MAX_SEEN:
+            self._seen.popitem(last=False)
+        if message.run_id:
+            self._last_seen[message.run_id] = message.id
+        return True
+
+    def catch_up(self, run_id: str) -> list:
+        # Fetch only the messages of a run that arrived after the last one seen
+        params = {"run_id": run_id, "order": "asc"}
+        if run_id in self._last_seen:
+            params["after"] = self._last_seen[run_id]
+        page = self.client.beta.threads.messages.list(self.thread_id, **params)
+        return [m for m in page.data if m.status != "in_progress" and self.observe(m)]
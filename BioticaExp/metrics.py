@@ -0,0 +1,189 @@
+# metrics.py
+import bisect
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Histogram:
+
+    # Upper bounds in seconds; the last bucket catches everything above
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+    # For API calls and tools, which take from milliseconds to minutes
+    DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+    def __init__(self, name: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class Counter:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Registry:
+
+    # Metric families by name, each holding one metric per set of label values
+
+    def __init__(self):
+        self._families = {} # name -> [kind, help, {label items: metric}]
+        self._lock = threading.Lock()
+
+    def register(self, name: str, metric, help: str = "", **labels):
+        # Exposes an existing Histogram or Counter; a metric with the same labels is replaced
+        kind = "histogram" if isinstance(metric, Histogram) else "counter"
+        with self._lock:
+            family = self._families.setdefault(name, [kind, help, {}])
+            family[2][tuple(sorted(labels.items()))] = metric
+        return metric
+
+    def _get(self, name: str, labels: dict):
+        with self._lock:
+            family = self._families.get(name)
+            return family[2].get(tuple(sorted(labels.items()))) if family else None
+
+    def histogram(self, name: str, help: str = "", buckets: tuple = Histogram.DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._get(name, labels) or self.register(name, Histogram(name, buckets), help, **labels)
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get(name, labels) or self.register(name, Counter(name), help, **labels)
+
+    def _snapshot(self) -> list:
+        with self._lock:
+            return [(name, kind, help, list(metrics.items())) for name, (kind, help, metrics) in sorted(self._families.items())]
+
+    def render(self) -> str:
+        # OpenMetrics text exposition
+        lines = []
+        for name, kind, help, metrics in self._snapshot():
+            lines.append(f"# TYPE {name} {kind}")
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            for labels, metric in metrics:
+                labels = dict(labels)
+                if kind == "counter":
+                    lines.append(f"{name}_total{_labels(labels)} {metric.value}")
+                    continue
+                with metric._lock:
+                    counts, count, total = list(metric.counts), metric.count, metric.sum
+                cumulative = 0
+                for bound, n in zip(metric.buckets, counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {count}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {total}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        summary = {}
+        for name, kind, _, metrics in self._snapshot():
+            for labels, metric in metrics:
+                key = name + _labels(dict(labels))
+                if kind == "counter":
+                    summary[key] = metric.value
+                elif metric.count:
+                    summary[key] = {k: round(v, 4) for k, v in metric.summary().items()}
+        return summary
+
+
+REGISTRY = Registry()
+
+
+class MetricsExporter:
+
+    # Serves the registry at http://<host>:<port>/metrics and writes a summary of it
+    # to the log every summary_interval seconds
+
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = "127.0.0.1", port: int = 9108, summary_interval: float = 300):
+        self.registry = registry
+        self.summary_interval = summary_interval
+        self._stop = threading.Event()
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="metrics-http").start()
+        threading.Thread(target=self._report, daemon=True, name="metrics-summary").start()
+
+    def _report(self):
+        while not self._stop.wait(self.summary_interval):
+            logging.info(f"metrics: {json.dumps(self.registry.summary())}")
+
+    def close(self):
+        self._stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+        logging.info(f"metrics: {json.dumps(self.registry.summary())}")
@@ -0,0 +1,178 @@
+# reasoning.py
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from clock import Clock, get_clock
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+
+class ReasoningError(Exception):
+    pass
+
+
+class ReasoningService:
+
+    # Runs get_reasoning_help calls in the background and keeps the answers in a
+    # persistent LRU cache keyed by the normalized request. An answer that is not
+    # ready before the caller stops waiting is handed to on_answer(request, answer),
+    # or on_answer(request, None, error=message) if the call failed. Failures are
+    # never cached.
+
+    MODEL = "o1"
+    MAX_ENTRIES = 256
+    TTL = 7*24*60*60 # 1 week
+
+    PROMPT = (
+        "You are a helpful assistant that helps another smaller LLM with complex reasoning tasks.\n"
+        "The smaller LLM is working on training two mice in a cage to perform certain tasks.\n"
+        "Here is the LLM's request for help:\n"
+        "{request}\n\n"
+        "Try to give the smaller LLM a detailed strategy that is based on scientific evidence and studies.\n"
+    )
+
+    MILESTONE_REQUEST = (
+        "I am training two mice to press a lever using a speaker, two levers and a water dispenser. "
+        "Another training session has just ended. Here are the behavior statistics so far:\n{stats}\n"
+        "What should I change or keep doing in the next sessions?"
+    )
+
+    def __init__(self, client: "OpenAI", clock: Clock = None, path: str = "reasoning_cache.json", on_answer=None):
+        self.client = client
+        self.clock = clock or get_clock()
+        self.path = path
+        self.on_answer = on_answer
+        self.cache = OrderedDict() # key -> {"request", "answer", "at"}, least recently used first
+        self.milestone = None # latest prefetched milestone advice that has not been shown yet
+        self._pending = {} # key -> {"waiters", "deliver", "answer"}
+        self._cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="reasoning")
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.cache.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable reasoning cache: {e}")
+
+    @staticmethod
+    def key(request: str) -> str:
+        # Case, punctuation and spacing do not make a different question
+        normalized = " ".join(re.sub(r"[^\w\s]", " ", request.lower()).split())
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def cached(self, request: str) -> str:
+        key = self.key(request)
+        with self._cond:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if self.clock.time() - entry["at"] > self.TTL:
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry["answer"]
+
+    def ask(self, request: str, wait: float) -> str:
+        # Returns the answer, or None if it is not ready within wait seconds (experiment clock).
+        # The call keeps running and its answer goes to on_answer when it arrives. Raises
+        # ReasoningError as soon as the call fails
+        answer = self.cached(request)
+        if answer is not None:
+            return answer
+        key = self.key(request)
+        with self._cond:
+            pending = self._start(key, request)
+            pending["waiters"] += 1
+            try:
+                self._cond.wait_for(
+                    lambda: pending["answer"] is not None or pending["error"] is not None,
+                    timeout=self.clock.timeout(wait),
+                )
+            finally:
+                pending["waiters"] -= 1
+            if pending["error"] is not None:
+                raise ReasoningError(pending["error"])
+            if pending["answer"] is None:
+                pending["deliver"] = True
+            return pending["answer"]
+
+    def prefetch(self, request: str):
+        # Warms the cache without delivering the answer anywhere
+        if self.cached(request) is None:
+            with self._cond:
+                self._start(self.key(request), request)
+
+    def prefetch_milestone(self, stats: str):
+        request = self.MILESTONE_REQUEST.format(stats=stats)
+        with self._cond:
+            pending = self._start(self.key(request), request)
+            pending["milestone"] = True
+
+    def take_milestone(self) -> str:
+        with self._cond:
+            advice, self.milestone = self.milestone, None
+        return advice
+
+    def _start(self, key: str, request: str) -> dict:
+        # Called with _cond held; joins a call that is already running for the same request
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = {"waiters": 0, "deliver": False, "milestone": False, "answer": None, "error": None}
+            self._pending[key] = pending
+            self.executor.submit(self._call, key, request, pending)
+        return pending
+
+    def _call(self, key: str, request: str, pending: dict):
+        try:
+            answer = self.client.chat.completions.create(
+                model=self.MODEL,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": self.PROMPT.format(request=request)
+                    }
+                ]
+            ).choices[0].message.content
+            if not answer:
+                raise ReasoningError("the reasoning model returned an empty answer")
+        except Exception as e:
+            print(f"Error getting reasoning help: {e}")
+            with self._cond:
+                del self._pending[key]
+                pending["error"] = str(e)
+                deliver = pending["deliver"] and not pending["waiters"]
+                self._cond.notify_all()
+            if deliver and self.on_answer:
+                self.on_answer(request, None, error=str(e))
+            return
+        with self._cond:
+            del self._pending[key]
+            pending["answer"] = answer
+            self.cache[key] = {"request": request, "answer": answer, "at": self.clock.time()}
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.MAX_ENTRIES:
+                self.cache.popitem(last=False)
+            self._save()
+            if pending["milestone"]:
+                self.milestone = answer
+            deliver = pending["deliver"] and not pending["waiters"]
+            self._cond.notify_all()
+        if deliver and self.on_answer:
+            self.on_answer(request, answer)
+
+    def _save(self):
+        # Called with _cond held
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
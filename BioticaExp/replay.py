@@ -0,0 +1,455 @@
+# replay.py
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import httpx
+
+
+# Record and replay of Assistants API traffic.
+#
+# Recording: with BIOTICA_RECORD=<cassette.jsonl> every request the agent's OpenAI
+# client makes, and the response to it, is appended to the cassette as one line.
+# Streamed responses keep each chunk with its offset from the request, so event
+# timing can be replayed as well.
+#
+#   {"seq": 3, "at": 1718000000.0, "method": "POST", "path": "/v1/threads/thread_x/runs",
+#    "request": {...}, "status": 200, "content_type": "text/event-stream",
+#    "chunks": [[0.41, "event: thread.run.created\ndata: {...}\n\n"], ...]}
+#
+# Replay: StubServer serves a cassette, or a scripted session built by script(),
+# on localhost. Point the agent at it with
+#
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python main.py
+#
+# Ids in paths (asst_..., thread_..., run_...) are ignored when matching requests.
+# Requests with the same method and path are answered in recorded order; reads and
+# other interactions marked "repeat" keep answering once their queue is down to
+# the last entry, everything else is answered once. Requests with nothing left to
+# answer get a 404, and `done` is set when nothing but repeats is left.
+
+ID_PATTERN = re.compile(r"\b(asst|thread|run|msg|call|step)_[A-Za-z0-9]+")
+EXPIRES_PATTERN = re.compile(r'"expires_at":\s*(\d+)')
+
+
+def route(method: str, path: str) -> tuple:
+    path = urlsplit(path).path
+    if path.startswith("/v1/"):
+        path = path[3:]
+    return method, ID_PATTERN.sub(lambda m: "{" + m.group(1) + "}", path.rstrip("/"))
+
+
+class Cassette:
+
+    # Appends interactions to a JSON lines file as their responses finish
+
+    def __init__(self, path: str):
+        self.path = path
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def next_seq(self) -> int:
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def write(self, interaction: dict):
+        line = json.dumps(interaction) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+    @staticmethod
+    def load(path: str) -> list:
+        with open(path) as f:
+            interactions = [json.loads(line) for line in f if line.strip()]
+        return sorted(interactions, key=lambda i: i["seq"])
+
+
+class _Recording:
+
+    def __init__(self, cassette: Cassette, request: httpx.Request, response: httpx.Response, started: float):
+        try:
+            body = json.loads(request.content) if request.content else None
+        except ValueError:
+            body = None
+        self.cassette = cassette
+        self.started = started
+        self.interaction = {
+            "seq": cassette.next_seq(),
+            "at": time.time(),
+            "method": request.method,
+            "path": request.url.raw_path.decode(),
+            "request": body,
+            "status": response.status_code,
+            "content_type": response.headers.get("content-type", ""),
+            "chunks": [],
+        }
+        self.closed = False
+
+    def add(self, chunk: bytes):
+        self.interaction["chunks"].append([time.monotonic() - self.started, chunk.decode(errors="replace")])
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.cassette.write(self.interaction)
+
+
+class _RecordingStream(httpx.SyncByteStream):
+
+    def __init__(self, stream, recording: _Recording):
+        self.stream = stream
+        self.recording = recording
+
+    def __iter__(self):
+        for chunk in self.stream:
+            self.recording.add(chunk)
+            yield chunk
+
+    def close(self):
+        self.stream.close()
+        self.recording.close()
+
+
+class _AsyncRecordingStream(httpx.AsyncByteStream):
+
+    def __init__(self, stream, recording: _Recording):
+        self.stream = stream
+        self.recording = recording
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            self.recording.add(chunk)
+            yield chunk
+
+    async def aclose(self):
+        await self.stream.aclose()
+        self.recording.close()
+
+
+class RecordingTransport(httpx.BaseTransport):
+
+    # Wraps the transport of the OpenAI client's httpx client. Only bodies are
+    # recorded, never request headers, so the API key stays out of the cassette
+
+    def __init__(self, cassette: Cassette, transport: httpx.BaseTransport = None):
+        self.cassette = cassette
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.headers["Accept-Encoding"] = "identity" # keep the recorded chunks readable
+        started = time.monotonic()
+        response = self.transport.handle_request(request)
+        recording = _Recording(self.cassette, request, response, started)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_RecordingStream(response.stream, recording),
+            extensions=response.extensions,
+        )
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRecordingTransport(httpx.AsyncBaseTransport):
+
+    def __init__(self, cassette: Cassette, transport: httpx.AsyncBaseTransport = None):
+        self.cassette = cassette
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.headers["Accept-Encoding"] = "identity"
+        started = time.monotonic()
+        response = await self.transport.handle_async_request(request)
+        recording = _Recording(self.cassette, request, response, started)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_AsyncRecordingStream(response.stream, recording),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+_cassettes = {}
+
+def _cassette(path: str) -> Cassette:
+    # One sequence for every client of the process, sync and async
+    if path not in _cassettes:
+        _cassettes[path] = Cassette(path)
+    return _cassettes[path]
+
+def http_client(limits: httpx.Limits = None) -> httpx.Client:
+    # The httpx client for an OpenAI client; records when BIOTICA_RECORD is set
+    from openai import DefaultHttpxClient
+    from openai._constants import DEFAULT_CONNECTION_LIMITS
+    path = os.getenv("BIOTICA_RECORD")
+    limits = limits or DEFAULT_CONNECTION_LIMITS
+    if not path:
+        return DefaultHttpxClient(limits=limits)
+    return DefaultHttpxClient(transport=RecordingTransport(_cassette(path), httpx.HTTPTransport(limits=limits)))
+
+def async_http_client(limits: httpx.Limits = None) -> httpx.AsyncClient:
+    from openai import DefaultAsyncHttpxClient
+    from openai._constants import DEFAULT_CONNECTION_LIMITS
+    path = os.getenv("BIOTICA_RECORD")
+    limits = limits or DEFAULT_CONNECTION_LIMITS
+    if not path:
+        return DefaultAsyncHttpxClient(limits=limits)
+    return DefaultAsyncHttpxClient(transport=AsyncRecordingTransport(_cassette(path), httpx.AsyncHTTPTransport(limits=limits)))
+
+
+# Scripted sessions
+
+def script(runs: list, model: str = "gpt-4o", answer: str = "Stub answer.") -> list:
+    # Builds a cassette from a list of runs. Each run is a list of steps; a step is
+    # either the text of an assistant message or a list of [name, arguments] tool
+    # calls. The run's stream stops at every tool call step and the next part is
+    # sent when the tool outputs are submitted, as with the real API.
+    #
+    #   script([[[["play_sound", {"duration": 1, "frequency": 4000}]], "Tone played."]])
+    now = int(time.time())
+    ids = defaultdict(int)
+    def new_id(kind):
+        ids[kind] += 1
+        return f"{kind}_stub{ids[kind]}"
+    assistant = {
+        "id": "asst_stub", "object": "assistant", "created_at": now, "model": model, "name": "Mouse Trainer",
+        "description": None, "instructions": "", "tools": [], "metadata": {}, "top_p": 1.0, "temperature": 1.0,
+        "response_format": "auto", "tool_resources": {},
+    }
+    thread = {"id": "thread_stub", "object": "thread", "created_at": now, "metadata": {}, "tool_resources": {}}
+
+    def run_object(run_id, status, tool_calls=None):
+        return {
+            "id": run_id, "object": "thread.run", "created_at": now, "thread_id": thread["id"],
+            "assistant_id": assistant["id"], "status": status, "model": model, "instructions": "", "tools": [],
+            "metadata": {}, "expires_at": now + 600, "started_at": now, "cancelled_at": None, "failed_at": None,
+            "completed_at": now if status == "completed" else None, "last_error": None, "incomplete_details": None,
+            "usage": None, "temperature": 1.0, "top_p": 1.0, "max_prompt_tokens": None, "max_completion_tokens": None,
+            "truncation_strategy": {"type": "auto", "last_messages": None}, "response_format": "auto",
+            "tool_choice": "auto", "parallel_tool_calls": True,
+            "required_action": {
+                "type": "submit_tool_outputs",
+                "submit_tool_outputs": {"tool_calls": tool_calls},
+            } if tool_calls else None,
+        }
+
+    def message_object(message_id, run_id, text, status):
+        return {
+            "id": message_id, "object": "thread.message", "created_at": now, "thread_id": thread["id"],
+            "run_id": run_id, "assistant_id": assistant["id"], "role": "assistant", "status": status,
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}] if text else [],
+            "attachments": [], "metadata": {}, "completed_at": None, "incomplete_at": None, "incomplete_details": None,
+        }
+
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    def interaction(method, path, body, repeat=False):
+        stream = isinstance(body, list)
+        return {
+            "method": method, "path": "/v1" + path, "status": 200, "repeat": repeat,
+            "content_type": "text/event-stream" if stream else "application/json",
+            "chunks": [[0, chunk] for chunk in body] if stream else [[0, json.dumps(body)]],
+        }
+
+    def page(data):
+        return {"object": "list", "data": data, "first_id": None, "last_id": None, "has_more": False}
+
+    cassette = [
+        interaction("POST", "/assistants", assistant),
+        interaction("GET", "/assistants/asst_stub", assistant, repeat=True),
+        interaction("POST", "/assistants/asst_stub", assistant, repeat=True),
+        interaction("POST", "/threads", thread),
+        interaction("GET", "/threads/thread_stub", thread, repeat=True),
+        interaction("POST", "/threads/thread_stub/messages", message_object("msg_user", None, "", "completed") | {"role": "user"}, repeat=True),
+        interaction("GET", "/threads/thread_stub/messages", page([]), repeat=True),
+        interaction("GET", "/threads/thread_stub/runs", page([]), repeat=True),
+        interaction("POST", "/threads/thread_stub/runs/run_stub/cancel", run_object("run_stub", "cancelled"), repeat=True),
+        interaction("GET", "/threads/thread_stub/runs/run_stub", run_object("run_stub", "requires_action"), repeat=True),
+        interaction("POST", "/chat/completions", {
+            "id": "chatcmpl_stub", "object": "chat.completion", "created": now, "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                         "message": {"role": "assistant", "content": answer, "refusal": None}}],
+        }, repeat=True),
+    ]
+    for steps in runs:
+        run_id = new_id("run")
+        chunks = [event("thread.run.created", run_object(run_id, "queued")),
+                  event("thread.run.in_progress", run_object(run_id, "in_progress"))]
+        path = "/threads/thread_stub/runs"
+        for step in steps:
+            if isinstance(step, str):
+                message_id = new_id("msg")
+                chunks += [
+                    event("thread.message.created", message_object(message_id, run_id, "", "in_progress")),
+                    event("thread.message.delta", {"id": message_id, "object": "thread.message.delta", "delta": {
+                        "content": [{"index": 0, "type": "text", "text": {"value": step, "annotations": []}}]
+                    }}),
+                    event("thread.message.completed", message_object(message_id, run_id, step, "completed")),
+                ]
+                continue
+            tool_calls = [
+                {"id": new_id("call"), "type": "function",
+                 "function": {"name": name, "arguments": json.dumps(arguments)}}
+                for name, arguments in step
+            ]
+            chunks.append(event("thread.run.requires_action", run_object(run_id, "requires_action", tool_calls)))
+            chunks.append("event: done\ndata: [DONE]\n\n")
+            cassette.append(interaction("POST", path, chunks))
+            path = f"/threads/thread_stub/runs/{run_id}/submit_tool_outputs"
+            chunks = [event("thread.run.queued", run_object(run_id, "queued")),
+                      event("thread.run.in_progress", run_object(run_id, "in_progress"))]
+        chunks.append(event("thread.run.completed", run_object(run_id, "completed")))
+        chunks.append("event: done\ndata: [DONE]\n\n")
+        cassette.append(interaction("POST", path, chunks))
+    return [dict(i, seq=seq) for seq, i in enumerate(cassette)]
+
+
+# Replay
+
+class StubServer:
+
+    # pace scales the recorded chunk timing: 1 replays in real time, 0 (the default)
+    # sends everything as fast as possible
+
+    def __init__(self, interactions: list, host: str = "127.0.0.1", port: int = 0, pace: float = 0):
+        self.pace = pace
+        self.queues = defaultdict(list)
+        for interaction in interactions:
+            self.queues[route(interaction["method"], interaction["path"])].append(interaction)
+        self.served = 0
+        self.unmatched = []
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._check_done()
+
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, like the real API
+            disable_nagle_algorithm = True # headers and body go out as separate writes
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                interaction = stub._take(route(self.command, self.path))
+                if interaction is None:
+                    stub._reply(self, 404, "application/json", [[0, json.dumps({"error": {
+                        "message": f"stub has no response for {self.command} {self.path}",
+                        "type": "invalid_request_error", "param": None, "code": None,
+                    }})]])
+                else:
+                    stub._reply(self, interaction["status"], interaction["content_type"], interaction["chunks"],
+                                interaction.get("at"))
+
+            do_GET = do_POST = do_DELETE = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        self.base_url = f"http://{self.host}:{self.port}/v1"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs):
+        # A recorded .jsonl cassette, or a .json script for script()
+        if path.endswith(".jsonl"):
+            return cls(Cassette.load(path), **kwargs)
+        with open(path) as f:
+            return cls(script(json.load(f)), **kwargs)
+
+    def _take(self, key: tuple) -> dict:
+        with self._lock:
+            queue = self.queues.get(key)
+            if not queue:
+                self.unmatched.append(key)
+                return None
+            interaction = queue[0]
+            if len(queue) > 1 or not (interaction.get("repeat") or interaction["method"] == "GET"):
+                queue.pop(0)
+            self.served += 1
+            self._check_done()
+        return interaction
+
+    def _check_done(self):
+        if all(
+            all(i.get("repeat") or i["method"] == "GET" for i in queue)
+            for queue in self.queues.values()
+        ):
+            self.done.set()
+
+    def _reply(self, handler, status: int, content_type: str, chunks: list, recorded_at: float = None):
+        # Recorded runs expired long ago; move expires_at as far into the future as it was then
+        shift = int(time.time() - recorded_at) if recorded_at else 0
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        if not content_type.startswith("text/event-stream"):
+            body = "".join(chunk for _, chunk in chunks)
+            body = self._shift(body, shift).encode()
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+            return
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        started = time.monotonic()
+        for offset, chunk in chunks:
+            if self.pace:
+                delay = started + offset * self.pace - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            data = self._shift(chunk, shift).encode()
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            handler.wfile.flush()
+        handler.wfile.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _shift(text: str, shift: int) -> str:
+        if not shift:
+            return text
+        return EXPIRES_PATTERN.sub(lambda m: f'"expires_at": {int(m.group(1)) + shift}', text)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded or scripted Assistants API sessions")
+    parser.add_argument("session", help="a recorded .jsonl cassette or a .json script")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--pace", type=float, default=0, help="1 replays the recorded timing, 0 sends at once")
+    args = parser.parse_args()
+    stub = StubServer.from_file(args.session, port=args.port, pace=args.pace)
+    print(f"OPENAI_BASE_URL={stub.base_url}")
+    try:
+        stub.done.wait()
+        print(f"session replayed, {stub.served} responses")
+        while True:
+            time.sleep(1) # stay up for the agent's shutdown requests
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if stub.unmatched:
+            print(f"unmatched requests: {sorted(set(stub.unmatched))}")
+        stub.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# session.py
+import hashlib
+import json
+import os
+
+import openai
+from openai import OpenAI
+
+
+class SessionManifest:
+
+    # Remembers the assistant and thread across restarts so a warm start skips
+    # re-creating them. The assistant is only updated when its config changes.
+
+    def __init__(self, path: str = "session.json"):
+        self.path = path
+        self.data = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable session manifest: {e}")
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def fingerprint(config: dict) -> str:
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def assistant(self, client: OpenAI, **config):
+        fingerprint = self.fingerprint(config)
+        assistant_id = self.data.get("assistant_id")
+        assistant = None
+        if assistant_id:
+            try:
+                if self.data.get("assistant_fingerprint") == fingerprint:
+                    assistant = client.beta.assistants.retrieve(assistant_id)
+                else:
+                    assistant = client.beta.assistants.update(assistant_id, **config)
+            except openai.NotFoundError:
+                assistant = None
+        if assistant is None:
+            assistant = client.beta.assistants.create(**config)
+        self.data["assistant_id"] = assistant.id
+        self.data["assistant_fingerprint"] = fingerprint
+        self.save()
+        return assistant
+
+    def thread(self, client: OpenAI) -> tuple:
+        # Returns (thread, resumed)
+        thread_id = self.data.get("thread_id")
+        if thread_id:
+            try:
+                return client.beta.threads.retrieve(thread_id), True
+            except openai.NotFoundError:
+                pass
+        thread = client.beta.threads.create()
+        self.set_thread(thread.id)
+        return thread, False
+
+    def set_thread(self, thread_id: str):
+        self.data["thread_id"] = thread_id
+        self.data.pop("thread_size", None)
+        self.save()
+
+    def thread_size(self) -> tuple:
+        # (messages, chars) last recorded for the current thread
+        return tuple(self.data.get("thread_size", (0, 0)))
+
+    def set_thread_size(self, messages: int, chars: int):
+        self.data["thread_size"] = [messages, chars]
+        self.save()
@@ -0,0 +1,345 @@
+# simulation.py
+import math
+import queue
+import random
+import threading
+
+from clock import Clock
+
+
+class SimulatedGPIO:
+
+    SIMULATED = True
+
+    # Same constants as RPi.GPIO
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self._levels = {}
+        self._modes = {}
+        self._detects = {} # channel -> (edge, callback, bouncetime, last edge time)
+        self._pwms = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+        # Edge callbacks run on one thread, like RPi.GPIO's callback thread
+        self._callbacks = queue.Queue()
+        threading.Thread(target=self._run_callbacks, daemon=True, name="sim-gpio-callbacks").start()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, mode, pull_up_down=PUD_OFF, initial=None):
+        with self._lock:
+            self._modes[channel] = mode
+            if mode == self.IN:
+                self._levels.setdefault(channel, self.HIGH if pull_up_down == self.PUD_UP else self.LOW)
+            else:
+                self._levels[channel] = initial if initial is not None else self._levels.get(channel, self.LOW)
+
+    def output(self, channel, value):
+        channels = channel if isinstance(channel, (list, tuple)) else [channel]
+        if isinstance(value, (list, tuple)):
+            values = [int(bool(v)) for v in value]
+        else:
+            values = [int(bool(value))] * len(channels)
+        with self._lock:
+            for c, v in zip(channels, values):
+                if self._modes.get(c) != self.OUT:
+                    raise RuntimeError(f"The GPIO channel {c} has not been set up as an OUTPUT")
+                self._levels[c] = v
+        self._notify("output", channels, values)
+
+    def input(self, channel):
+        with self._lock:
+            return self._levels.get(channel, self.LOW)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self._lock:
+            self._detects[channel] = [edge, callback, (bouncetime or 0) / 1000, -math.inf]
+
+    def remove_event_detect(self, channel):
+        with self._lock:
+            self._detects.pop(channel, None)
+
+    def PWM(self, channel, frequency):
+        with self._lock:
+            if channel in self._pwms and self._pwms[channel].running:
+                raise RuntimeError("A PWM object already exists for this GPIO channel")
+            pwm = SimulatedPWM(self, channel, frequency)
+            self._pwms[channel] = pwm
+            return pwm
+
+    def cleanup(self, channel=None):
+        pass
+
+    # Simulation side
+
+    def add_listener(self, fn):
+        # fn(kind, channels, values) for "output" and "pwm" changes
+        self._listeners.append(fn)
+
+    def set_input(self, channel, level):
+        # Drive an input line from the outside world, e.g. a lever switch
+        with self._lock:
+            previous = self._levels.get(channel)
+            self._levels[channel] = level
+            detect = self._detects.get(channel)
+            if detect is None or previous == level:
+                return
+            edge, callback, bouncetime, last = detect
+            rising = level == self.HIGH
+            if edge != self.BOTH and edge != (self.RISING if rising else self.FALLING):
+                return
+            now = self.clock.monotonic()
+            if now - last < bouncetime:
+                return
+            detect[3] = now
+        if callback:
+            self._callbacks.put((callback, channel))
+
+    def _notify(self, kind, channels, values):
+        for fn in self._listeners:
+            fn(kind, channels, values)
+
+    def _run_callbacks(self):
+        while True:
+            callback, channel = self._callbacks.get()
+            try:
+                callback(channel)
+            except Exception as e:
+                print(f"Error in GPIO callback: {e}")
+
+
+class SimulatedPWM:
+
+    def __init__(self, gpio: SimulatedGPIO, channel: int, frequency: float):
+        self.gpio = gpio
+        self.channel = channel
+        self.frequency = frequency
+        self.duty_cycle = 0
+        self.running = False
+
+    def start(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.running = True
+        self._notify()
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+        self._notify()
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self._notify()
+
+    def stop(self):
+        self.running = False
+        self._notify()
+
+    def sounding(self) -> bool:
+        return self.running and self.duty_cycle > 0
+
+    def _notify(self):
+        self.gpio._notify("pwm", [self.channel], [self.frequency if self.sounding() else 0])
+
+
+class SimulatedFeeder:
+
+    # Coil patterns in half-step order; full-step patterns are every other entry
+    PHASES = [
+        (1,0,0,0), (1,1,0,0), (0,1,0,0), (0,1,1,0),
+        (0,0,1,0), (0,0,1,1), (0,0,0,1), (1,0,0,1),
+    ]
+
+    def __init__(self, gpio: SimulatedGPIO, pins: list, switch_pin: int, travel: int = 1600):
+        # position counts half-steps down from the lifted rest position; the limit
+        # switch closes (reads LOW) once the spout reaches the bottom of its travel
+        self.gpio = gpio
+        self.pins = list(pins)
+        self.switch_pin = switch_pin
+        self.travel = travel
+        self.position = 0
+        self._phase = None
+        gpio.add_listener(self._on_change)
+
+    def lowered(self) -> bool:
+        return self.position >= self.travel
+
+    def _on_change(self, kind, channels, values):
+        if kind != "output" or not any(c in self.pins for c in channels):
+            return
+        pattern = tuple(self.gpio.input(p) for p in self.pins)
+        if pattern not in self.PHASES:
+            return
+        phase = self.PHASES.index(pattern)
+        if self._phase is not None:
+            delta = (phase - self._phase) % len(self.PHASES)
+            if delta > len(self.PHASES) // 2:
+                delta -= len(self.PHASES)
+            self.position += delta
+        self._phase = phase
+        self.gpio.set_input(self.switch_pin, self.gpio.LOW if self.lowered() else self.gpio.HIGH)
+
+
+class MouseModel:
+
+    def __init__(
+        self,
+        base_rate: float = 1/300,
+        cue_rate: float = 1/5,
+        cue_window: float = 5,
+        reward_window: float = 5,
+        learning_rate: float = 0.1,
+        extinction_rate: float = 0.02,
+        left_bias: float = 0.5,
+        hold_time: float = 0.3,
+        seed: int = None,
+    ):
+        self.base_rate = base_rate # spontaneous presses per second
+        self.cue_rate = cue_rate # extra presses per second after a tone, at full association
+        self.cue_window = cue_window # seconds after a tone during which it drives pressing
+        self.reward_window = reward_window # seconds after a press in which water counts as its reward
+        self.learning_rate = learning_rate
+        self.extinction_rate = extinction_rate
+        self.left_bias = left_bias
+        self.hold_time = hold_time
+        self.random = random.Random(seed)
+
+
+class VirtualMouse:
+
+    TICK = 0.01 # seconds
+
+    def __init__(self, gpio: SimulatedGPIO, lever_pins: list, feeder: SimulatedFeeder, speaker_pin: int, model: MouseModel = None):
+        self.gpio = gpio
+        self.clock = gpio.clock
+        self.lever_pins = list(lever_pins)
+        self.feeder = feeder
+        self.speaker_pin = speaker_pin
+        self.model = model or MouseModel()
+
+        self.lever_value = 0.0 # learned press -> water association
+        self.cue_value = 0.0 # learned tone -> press -> water association
+        self.presses = [0, 0]
+        self.rewards = 0
+
+        self._tone_on = False
+        self._tone_off_at = -math.inf
+        self._last_press = None # (time, cued)
+        self._release_at = None
+        self._pressed_pin = None
+        self._was_lowered = False
+        self._stop = threading.Event()
+        self._thread = None
+        gpio.add_listener(self._on_change)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="virtual-mouse")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _on_change(self, kind, channels, values):
+        if kind == "pwm" and self.speaker_pin in channels:
+            sounding = bool(values[channels.index(self.speaker_pin)])
+            if self._tone_on and not sounding:
+                self._tone_off_at = self.clock.monotonic()
+            self._tone_on = sounding
+
+    def _cued(self, now: float) -> bool:
+        return self._tone_on or now - self._tone_off_at < self.model.cue_window
+
+    def _hazard(self, now: float) -> float:
+        rate = self.model.base_rate * (1 + 9 * self.lever_value)
+        if self._cued(now):
+            rate += self.model.cue_rate * self.cue_value
+        return rate
+
+    def _learn(self, now: float):
+        model = self.model
+        lowered = self.feeder.lowered()
+        if lowered and not self._was_lowered:
+            if self._last_press and now - self._last_press[0] < model.reward_window:
+                self.rewards += 1
+                self.lever_value += model.learning_rate * (1 - self.lever_value)
+                if self._last_press[1]:
+                    self.cue_value += model.learning_rate * (1 - self.cue_value)
+                self._last_press = None
+        self._was_lowered = lowered
+        if self._last_press and now - self._last_press[0] >= model.reward_window:
+            # Pressed and nothing came of it
+            self.lever_value -= model.extinction_rate * self.lever_value
+            if self._last_press[1]:
+                self.cue_value -= model.extinction_rate * self.cue_value
+            self._last_press = None
+
+    def _press(self, now: float):
+        lever = 0 if self.model.random.random() < self.model.left_bias else 1
+        self.presses[lever] += 1
+        self._pressed_pin = self.lever_pins[lever]
+        self._release_at = now + self.model.random.expovariate(1 / self.model.hold_time)
+        self._last_press = (now, self._cued(now))
+        self.gpio.set_input(self._pressed_pin, self.gpio.LOW)
+
+    def _run(self):
+        last = self.clock.monotonic()
+        while not self._stop.is_set():
+            now = self.clock.monotonic()
+            # Use the time that actually passed; under a fast clock a tick can cover far more than TICK
+            dt, last = now - last, now
+            self._learn(now)
+            if self._pressed_pin is not None:
+                if now >= self._release_at:
+                    self.gpio.set_input(self._pressed_pin, self.gpio.HIGH)
+                    self._pressed_pin = None
+            elif not self.feeder.lowered(): # busy drinking otherwise
+                if self.model.random.random() < 1 - math.exp(-self._hazard(now) * dt):
+                    self._press(now)
+            self.clock.sleep(self.TICK)
+
+
+class Habitat:
+
+    def __init__(self, gpio: SimulatedGPIO, controller, model: MouseModel = None):
+        # Wires the simulated feeder and mouse to the pins a MainController drives
+        self.gpio = gpio
+        self.feeder = SimulatedFeeder(gpio, controller.feeder.PINS, controller.feeder.SWITCH_PIN, travel=controller.feeder.LIFT_PHASES)
+        self.mouse = VirtualMouse(
+            gpio,
+            [controller.LEFT_LEVER_SWITCH, controller.RIGHT_LEVER_SWITCH],
+            self.feeder,
+            controller.speaker.SPEAKER_PIN,
+            model,
+        )
+
+    def start(self):
+        self.mouse.start()
+
+    def stop(self):
+        self.mouse.stop()
+
+    def summary(self) -> dict:
+        return {
+            "presses": list(self.mouse.presses),
+            "rewards": self.mouse.rewards,
+            "lever_value": self.mouse.lever_value,
+            "cue_value": self.mouse.cue_value,
+        }
@@ -0,0 +1,224 @@
+# stats.py
+import math
+import threading
+
+from eventstore import EventStore, EventType
+
+
+class DecayingRate:
+
+    # Exponentially weighted event rate with time constant tau; O(1) per event
+
+    def __init__(self, tau: float):
+        self.tau = tau
+        self._value = 0.0
+        self._at = None
+
+    def _decay(self, now: float) -> float:
+        if self._at is None:
+            return 0.0
+        return self._value * math.exp(-(now - self._at) / self.tau)
+
+    def add(self, now: float):
+        self._value = self._decay(now) + 1 / self.tau
+        self._at = now
+
+    def rate(self, now: float) -> float:
+        return self._decay(now)
+
+
+class RunningMean:
+
+    # Welford mean and variance
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    def std(self) -> float:
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class Session:
+
+    def __init__(self, start: float):
+        self.start = start
+        self.presses = [0, 0]
+        self.cued_presses = 0
+        self.tones = 0
+        self.rewards = 0
+        self.hits = 0
+        self.misses = 0
+        self.latency = RunningMean()
+        self.hold = RunningMean()
+
+    def summary(self) -> dict:
+        judged = self.hits + self.misses
+        return {
+            "start": round(self.start),
+            "left_presses": self.presses[0],
+            "right_presses": self.presses[1],
+            "tones": self.tones,
+            "cued_press_rate": round(self.cued_presses / self.tones, 3) if self.tones else None,
+            "rewards": self.rewards,
+            "hit_rate_after_reward": round(self.hits / judged, 3) if judged else None,
+            "mean_latency": round(self.latency.mean, 2) if self.latency.count else None,
+            "mean_hold": round(self.hold.mean, 3) if self.hold.count else None,
+        }
+
+
+class BehaviorStats:
+
+    RATE_WINDOWS = {"1m": 60, "10m": 10*60, "1h": 60*60}
+    CUE_WINDOW = 30 # a press this long after tone onset counts as a response to it
+    REWARD_WINDOW = 60 # a press this long after a reward counts as a hit
+    SESSION_LENGTH = 60*60 # learning curve resolution
+    BURST_GAP = 1 # presses closer together than this belong to one burst
+    MAX_SESSIONS = 24*14
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rates = [{k: DecayingRate(tau) for k, tau in self.RATE_WINDOWS.items()} for _ in range(2)]
+        self.presses = [0, 0]
+        self.latency = RunningMean()
+        self.recent_latency = None # exponentially weighted
+        self.hits = 0
+        self.misses = 0
+        self.holds = [RunningMean(), RunningMean()]
+        self.bursts = RunningMean() # presses per burst, for bursts of two or more
+        self.longest_burst = 0
+        self._burst = 0 # presses in the current burst
+        self._last_press_at = None
+        self.sessions = []
+        self._session = None
+        self._tone_at = None # onset of the last tone that has not been answered yet
+        self._reward_at = None # end of the last reward that has not been followed by a press yet
+        self.on_session_end = None # called with the summary of each finished session, under the lock
+
+    def _session_at(self, now: float) -> Session:
+        if self._session is None or now - self._session.start >= self.SESSION_LENGTH:
+            if self._session is not None:
+                self.sessions.append(self._session.summary())
+                del self.sessions[:-self.MAX_SESSIONS]
+                if self.on_session_end:
+                    self.on_session_end(self.sessions[-1])
+            start = now if self._session is None else self._session.start + self.SESSION_LENGTH * ((now - self._session.start) // self.SESSION_LENGTH)
+            self._session = Session(start)
+        return self._session
+
+    def _expire(self, now: float, session: Session):
+        if self._reward_at is not None and now - self._reward_at > self.REWARD_WINDOW:
+            self.misses += 1
+            session.misses += 1
+            self._reward_at = None
+        if self._tone_at is not None and now - self._tone_at > self.CUE_WINDOW:
+            self._tone_at = None
+        if self._burst and now - self._last_press_at > self.BURST_GAP:
+            self._end_burst()
+
+    def on_press(self, lever: int, now: float):
+        with self._lock:
+            session = self._session_at(now)
+            self._expire(now, session)
+            self.presses[lever] += 1
+            session.presses[lever] += 1
+            for rate in self.rates[lever].values():
+                rate.add(now)
+            if self._last_press_at is not None and now - self._last_press_at <= self.BURST_GAP:
+                self._burst += 1
+            else:
+                self._end_burst()
+                self._burst = 1
+            self._last_press_at = now
+            if self._tone_at is not None:
+                latency = now - self._tone_at
+                self.latency.add(latency)
+                session.latency.add(latency)
+                session.cued_presses += 1
+                self.recent_latency = latency if self.recent_latency is None else 0.8 * self.recent_latency + 0.2 * latency
+                self._tone_at = None
+            if self._reward_at is not None:
+                self.hits += 1
+                session.hits += 1
+                self._reward_at = None
+
+    def _end_burst(self):
+        # Called with the lock held
+        if self._burst >= 2:
+            self.bursts.add(self._burst)
+            self.longest_burst = max(self.longest_burst, self._burst)
+        self._burst = 0
+
+    def on_release(self, lever: int, hold: float):
+        with self._lock:
+            self.holds[lever].add(hold)
+            if self._session is not None:
+                self._session.hold.add(hold)
+
+    def on_tone(self, now: float):
+        with self._lock:
+            session = self._session_at(now)
+            self._expire(now, session)
+            session.tones += 1
+            self._tone_at = now
+
+    def on_reward(self, now: float):
+        # Called when the water is lifted again
+        with self._lock:
+            session = self._session_at(now)
+            self._expire(now, session)
+            session.rewards += 1
+            self._reward_at = now
+
+    def load(self, events: EventStore, since: float = None):
+        # Rebuild from stored events, e.g. after a restart
+        for timestamp, device, event, param1, _ in events.records(start=since):
+            if event == EventType.PRESS:
+                self.on_press(device, timestamp)
+            elif event == EventType.RELEASE:
+                self.on_release(device, param1)
+            elif event == EventType.TONE_ON:
+                self.on_tone(timestamp)
+            elif event == EventType.FEED_END and param1:
+                self.on_reward(timestamp)
+
+    def summary(self, now: float, sessions: int = 12) -> dict:
+        with self._lock:
+            session = self._session_at(now)
+            self._expire(now, session)
+            judged = self.hits + self.misses
+            return {
+                "press_rate_per_minute": {
+                    lever: {k: round(r.rate(now) * 60, 3) for k, r in self.rates[i].items()}
+                    for i, lever in enumerate(["left", "right"])
+                },
+                "total_presses": {"left": self.presses[0], "right": self.presses[1]},
+                "tone_to_press_latency": {
+                    "count": self.latency.count,
+                    "mean": round(self.latency.mean, 2) if self.latency.count else None,
+                    "std": round(self.latency.std(), 2) if self.latency.count else None,
+                    "recent": round(self.recent_latency, 2) if self.recent_latency is not None else None,
+                },
+                "hit_rate_after_reward": round(self.hits / judged, 3) if judged else None,
+                "hold_time": {
+                    lever: {
+                        "count": self.holds[i].count,
+                        "mean": round(self.holds[i].mean, 3) if self.holds[i].count else None,
+                        "std": round(self.holds[i].std(), 3) if self.holds[i].count else None,
+                    }
+                    for i, lever in enumerate(["left", "right"])
+                },
+                "bursts": {
+                    "count": self.bursts.count,
+                    "mean_presses": round(self.bursts.mean, 2) if self.bursts.count else None,
+                    "longest": self.longest_burst,
+                },
+                "learning_curve": self.sessions[-(sessions - 1):] + [session.summary()] if sessions > 1 else [session.summary()],
+            }
@@ -0,0 +1,179 @@
+# supervisor.py
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+from engine import TrainingAgent
+from controller import MainController
+from telemetry import LogSink
+from replay import http_client, async_http_client
+from main import _start_habitat, _stop_habitat, start_metrics, stop_metrics
+
+
+class CageSupervisor:
+
+    # Drives several cages from one process. Each cage gets its own TrainingAgent,
+    # pins and directory (events.bin, session.json, agent.log, spools), and its own
+    # interrupt FIFO at /tmp/interrupt-<name>. The OpenAI clients, and with them the
+    # HTTP connection pool, and the remote log sink are shared.
+    #
+    # The config file looks like
+    #
+    #   {"cages": {
+    #       "cage1": {},
+    #       "cage2": {"dir": "/data/cage2", "pins": {
+    #           "LEFT_LEVER_LED": 5, "RIGHT_LEVER_LED": 6, "LEFT_LEVER_SWITCH": 13, "RIGHT_LEVER_SWITCH": 19,
+    #           "FEEDER_PINS": [23, 24, 25, 12], "FEEDER_SWITCH_PIN": 4, "SPEAKER_PIN": 9, "SPEAKER_LED": 11
+    #       }, "debounce": [0.01, 0.02]}
+    #   }}
+    #
+    # Pin names are MainController.PIN_NAMES and anything not given keeps its default,
+    # so all but one cage need a full pin set: no GPIO line may belong to two cages.
+    # debounce is the left and right lever debounce in seconds, default
+    # MainController.LEVER_DEBOUNCE. Cages default to cages/<name>.
+
+    CONNECTIONS_PER_CAGE = 4
+    RESTART_DELAY = 5 # seconds before a cage that crashed starts training again
+
+    def __init__(self, config: dict, use_async: bool = False):
+        self.cages = config["cages"]
+        self.use_async = use_async
+        self._check_pins()
+        limits = httpx.Limits(
+            max_connections=self.CONNECTIONS_PER_CAGE * len(self.cages),
+            max_keepalive_connections=self.CONNECTIONS_PER_CAGE * len(self.cages),
+        )
+        self.client = OpenAI(http_client=http_client(limits))
+        self.aclient = AsyncOpenAI(http_client=async_http_client(limits)) if use_async else None
+        self.log_sink = LogSink(os.getenv("LOG_URL"), os.getenv("API_KEY"))
+        self.agents = {}
+        self.habitats = {}
+        self.exporter = None
+        self._stop = threading.Event()
+
+    def _check_pins(self):
+        # Fails before any hardware is touched, rather than on the second cage's PWM
+        owners = {} # GPIO line -> (cage, pin name)
+        for cage, config in self.cages.items():
+            try:
+                lines = MainController.pin_map(config.get("pins"))
+            except ValueError as e:
+                raise ValueError(f"{cage}: {e}") from None
+            for pin_name, value in lines.items():
+                for line in (value if isinstance(value, (list, tuple)) else [value]):
+                    if line in owners:
+                        other, other_name = owners[line]
+                        raise ValueError(
+                            f"GPIO {line} is both {other} {other_name} and {cage} {pin_name}; "
+                            "give every cage its own full pin set"
+                        )
+                    owners[line] = (cage, pin_name)
+
+    def _create(self, name: str) -> TrainingAgent:
+        cage = self.cages[name]
+        kwargs = dict(
+            client=self.client,
+            name=name,
+            data_dir=cage.get("dir", os.path.join("cages", name)),
+            pins=cage.get("pins"),
+            debounce=cage.get("debounce"),
+            log_sink=self.log_sink,
+        )
+        if self.use_async:
+            from async_engine import AsyncTrainingAgent
+            return AsyncTrainingAgent(aclient=self.aclient, **kwargs)
+        return TrainingAgent(**kwargs)
+
+    def start(self):
+        # Assistant and thread setup is mostly network round trips, so cages start together
+        with ThreadPoolExecutor(max_workers=len(self.cages)) as executor:
+            self.agents = dict(zip(self.cages, executor.map(self._create, self.cages)))
+        for name, agent in self.agents.items():
+            self.habitats[name] = _start_habitat(agent)
+            print(f"{name}: assistant {agent.assistant.id}, thread {agent.thread.id}")
+        self.exporter = start_metrics() # one endpoint for all cages, labelled by cage
+
+    def _run_cage(self, name: str, agent: TrainingAgent):
+        while not self._stop.is_set():
+            try:
+                agent.train()
+                agent.reset()
+            except Exception:
+                print(f"{name} crashed, restarting in {self.RESTART_DELAY} seconds")
+                agent.logger.error(traceback.format_exc())
+                # The crashed run is still active on the thread and would reject every retry
+                try:
+                    agent.reset()
+                except Exception as e:
+                    print(f"Error resetting {name}: {e}")
+                time.sleep(self.RESTART_DELAY)
+
+    async def _run_cage_async(self, name: str, agent):
+        await agent.start()
+        while True:
+            try:
+                await agent.train()
+                await agent.reset()
+            except Exception:
+                print(f"{name} crashed, restarting in {self.RESTART_DELAY} seconds")
+                agent.logger.error(traceback.format_exc())
+                try:
+                    await agent.reset()
+                except Exception as e:
+                    print(f"Error resetting {name}: {e}")
+                await asyncio.sleep(self.RESTART_DELAY)
+
+    def run(self):
+        try:
+            if self.use_async:
+                asyncio.run(self._run_async())
+            else:
+                threads = [
+                    threading.Thread(target=self._run_cage, args=item, daemon=True, name=f"cage-{item[0]}")
+                    for item in self.agents.items()
+                ]
+                for thread in threads:
+                    thread.start()
+                while any(thread.is_alive() for thread in threads):
+                    time.sleep(1)
+        finally:
+            self.cleanup()
+
+    async def _run_async(self):
+        # Every cage on one event loop
+        await asyncio.gather(*[self._run_cage_async(name, agent) for name, agent in self.agents.items()])
+
+    def cleanup(self):
+        print("Cleaning up...")
+        self._stop.set()
+        for name, agent in self.agents.items():
+            _stop_habitat(self.habitats.get(name))
+            try:
+                agent.cleanup()
+            except Exception as e:
+                print(f"Error cleaning up {name}: {e}")
+        self.log_sink.close()
+        stop_metrics(self.exporter)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train mice in several cages from one process")
+    parser.add_argument("config", help="JSON file with the cages and their pins")
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    supervisor = CageSupervisor(config, use_async=os.getenv("BIOTICA_ENGINE", "sync") == "async")
+    supervisor.start()
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# telemetry.py
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from clock import Clock
+from metrics import Histogram, REGISTRY
+
+
+class LogSink:
+
+    BATCH_SIZE = 50
+    FLUSH_INTERVAL = 0.5 # seconds to wait for a batch to fill
+    MAX_QUEUE = 10000 # events held in memory before new ones are dropped
+    MAX_SPOOL_BATCHES = 20000 # on-disk backlog, in batches
+    DRAIN_BATCHES = 10 # spooled batches resent per worker cycle
+    RETRY_BACKOFF = [1, 2, 5, 10, 30, 60]
+    REQUEST_TIMEOUT = 5
+
+    def __init__(self, url: str, api_key: str = None, spool_dir: str = "log_spool", clock: Clock = None):
+        self.url = url
+        self.clock = clock or Clock()
+        self.spool_dir = spool_dir
+        self.sent = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.post_latency = REGISTRY.histogram(
+            "biotica_log_post_seconds", "Successful log batch POSTs", Histogram.DURATION_BUCKETS
+        )
+        self.post_failures = REGISTRY.counter("biotica_log_post_failures", "Log batch POSTs that failed")
+
+        self._queue = queue.Queue(maxsize=self.MAX_QUEUE)
+        self._session = self._open_session(api_key) if url else None
+        self._spool_count = len(self._spool_files())
+        self._failures = 0
+        self._retry_at = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, data: dict):
+        # Called from the agent thread -- never blocks
+        if not self.url:
+            return
+        try:
+            # Event time is on the experiment clock; retries and backoff stay in real time
+            self._queue.put_nowait({"data": data, "timestamp": self.clock.time()})
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 10):
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._session:
+            self._session.close()
+        if self.dropped:
+            logging.warning(f"log sink dropped {self.dropped} events")
+
+    @staticmethod
+    def _open_session(api_key: str):
+        # requests is only imported when there is somewhere to send logs
+        import requests
+        session = requests.Session()
+        session.headers.update({
+            "Content-Type": "application/json",
+            "X-API-Key": api_key or "",
+        })
+        return session
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch:
+                self._dispatch(batch)
+            elif self._stop.is_set():
+                return
+            if self._spool_count and self._online() and self._queue.empty():
+                self._drain_spool()
+
+    def _collect(self) -> list:
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.FLUSH_INTERVAL))
+        except queue.Empty:
+            return batch
+        while len(batch) < self.BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _online(self) -> bool:
+        return time.monotonic() >= self._retry_at
+
+    def _dispatch(self, batch: list):
+        # While the endpoint is backing off, go straight to disk so memory stays bounded
+        if not self._online() or not self._post(batch):
+            self._spool(batch)
+
+    def _post(self, batch: list) -> bool:
+        start = time.monotonic()
+        try:
+            response = self._session.post(self.url, json=batch, timeout=self.REQUEST_TIMEOUT)
+            response.raise_for_status()
+        except Exception as e:
+            self.post_failures.inc()
+            delay = self.RETRY_BACKOFF[min(self._failures, len(self.RETRY_BACKOFF) - 1)]
+            self._failures += 1
+            self._retry_at = time.monotonic() + delay
+            logging.warning(f"Error logging data, retrying in {delay}s: {e}")
+            return False
+        self.post_latency.observe(time.monotonic() - start)
+        self._failures = 0
+        self.sent += len(batch)
+        return True
+
+    def _spool(self, batch: list):
+        # One file per batch, named so that lexical order is arrival order
+        if self._spool_count >= self.MAX_SPOOL_BATCHES:
+            self.dropped += len(batch)
+            return
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            path = os.path.join(self.spool_dir, f"{time.time_ns():020d}.json")
+            with open(path + ".tmp", "w") as spool:
+                json.dump(batch, spool, default=str)
+            os.replace(path + ".tmp", path)
+            self._spool_count += 1
+            self.spooled += len(batch)
+        except OSError as e:
+            self.dropped += len(batch)
+            logging.error(f"Error spooling log data: {e}")
+
+    def _spool_files(self) -> list:
+        try:
+            return sorted(f for f in os.listdir(self.spool_dir) if f.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def _drain_spool(self):
+        # Drain a few batches per cycle so live events are not starved
+        drained = 0
+        files = self._spool_files()
+        self._spool_count = len(files)
+        for name in files[:self.DRAIN_BATCHES]:
+            path = os.path.join(self.spool_dir, name)
+            try:
+                with open(path) as spool:
+                    batch = json.load(spool)
+            except (OSError, ValueError):
+                batch = None # partial file from a crash mid-write
+            if batch and not self._post(batch):
+                break
+            os.remove(path)
+            self._spool_count -= 1
+            drained += len(batch or [])
+        if drained:
+            logging.info(f"drained {drained} spooled log events")
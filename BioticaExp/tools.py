@@ -49,6 +49,62 @@ play_sound = {
     }
 }
 
+play_pattern = {
+    "type": "function",
+    "function": {
+        "name": "play_pattern",
+        "description": "Starts playing a cue pattern made of several segments and returns right away while it plays. A segment is a steady tone, a sweep from one frequency to another, or a silent gap. The whole list of segments is played repeat times in a row, for at most 3 minutes in total. Starting a new pattern or sound stops the one that is playing. The frequency range is 50 - 10000 Hz. Returns JSON with the total duration of the pattern in seconds, or an error.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "required": [
+                "segments",
+                "repeat"
+            ],
+            "properties": {
+                "segments": {
+                    "type": "array",
+                    "description": "The segments in the order they are played, at most 50.",
+                    "items": {
+                        "type": "object",
+                        "required": [
+                            "kind",
+                            "frequency",
+                            "end_frequency",
+                            "duration"
+                        ],
+                        "properties": {
+                            "kind": {
+                                "type": "string",
+                                "enum": ["tone", "sweep", "gap"],
+                                "description": "tone plays frequency, sweep glides from frequency to end_frequency, gap is silence."
+                            },
+                            "frequency": {
+                                "type": "number",
+                                "description": "The frequency of a tone, or the starting frequency of a sweep, in Hertz. Ignored for gaps."
+                            },
+                            "end_frequency": {
+                                "type": "number",
+                                "description": "The final frequency of a sweep in Hertz. Ignored for tones and gaps."
+                            },
+                            "duration": {
+                                "type": "number",
+                                "description": "The duration of the segment in seconds."
+                            }
+                        },
+                        "additionalProperties": False
+                    }
+                },
+                "repeat": {
+                    "type": "integer",
+                    "description": "How many times to play the segments, between 1 and 100."
+                }
+            },
+            "additionalProperties": False
+        }
+    }
+}
+
 wait_for_lever = {
     "type": "function",
     "function": {
@@ -97,7 +153,7 @@ get_human_help = {
     "type": "function",
     "function": {
         "name": "get_human_help",
-        "description": "When your are stuck, you can use this tool to get help/input from a human to adjust your experiment strategy. This tool can be used at most once every 1 hour and will be disabled if it was used within the last 1 hour (3600 seconds).",
+        "description": "When your are stuck, you can use this tool to get help/input from a human to adjust your experiment strategy. This tool can be used at most once every 1 hour and will be disabled if it was used within the last 1 hour (3600 seconds). If no human answers within 2 minutes it returns a ticket number, and the answer is sent to you as a message once it arrives.",
         "strict": True,
         "parameters": {
             "type": "object",
@@ -137,4 +193,72 @@ get_reasoning_help = {
     }
 }
 
-tools = [feed, play_sound, wait_for_lever, delay, get_human_help, get_reasoning_help]
+run_trials = {
+    "type": "function",
+    "function": {
+        "name": "run_trials",
+        "description": "Runs a block of identical trials locally and returns one summary of the whole block. Each trial plays a tone, waits for a lever press during the response window (which opens at tone onset), lowers the water bottle if the pressed lever is rewarded, and then waits for the inter-trial interval. Use this instead of calling play_sound, wait_for_lever, feed and delay once per trial. The whole block can take at most 8 minutes, counting about 4 seconds of feeder travel for every reward. Returns JSON with the number of trials, presses per lever, misses, rewards delivered, the response rate and the press latencies from tone onset in seconds.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "required": [
+                "tone_frequency",
+                "tone_duration",
+                "response_window",
+                "rewarded_lever",
+                "reward_duration",
+                "inter_trial_interval",
+                "repeat"
+            ],
+            "properties": {
+                "tone_frequency": {
+                    "type": "number",
+                    "description": "The frequency of the cue tone in Hertz. The frequency range is 50 - 10000 Hz."
+                },
+                "tone_duration": {
+                    "type": "number",
+                    "description": "The duration of the cue tone in seconds. Use 0 for trials without a tone."
+                },
+                "response_window": {
+                    "type": "number",
+                    "description": "The time in seconds, from tone onset, to wait for a lever press."
+                },
+                "rewarded_lever": {
+                    "type": "string",
+                    "enum": ["left", "right", "any", "none"],
+                    "description": "Which lever press is rewarded with water."
+                },
+                "reward_duration": {
+                    "type": "number",
+                    "description": "The duration to lower the water bottle in seconds after a rewarded press."
+                },
+                "inter_trial_interval": {
+                    "type": "number",
+                    "description": "The time in seconds to wait after each trial before the next one starts."
+                },
+                "repeat": {
+                    "type": "integer",
+                    "description": "The number of trials to run, between 1 and 100."
+                }
+            },
+            "additionalProperties": False
+        }
+    }
+}
+
+get_stats = {
+    "type": "function",
+    "function": {
+        "name": "get_stats",
+        "description": "Returns a precomputed JSON summary of the mice's behavior so far: press rates per lever over the last minute, 10 minutes and hour (presses per minute), total presses, the latency from tone onset to the next press, the fraction of rewards that were followed by another press within a minute, how long presses on each lever are held in seconds, bursts of presses less than a second apart, and an hourly learning curve for the most recent hours. Use this instead of working these numbers out from earlier function results.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "required": [],
+            "properties": {},
+            "additionalProperties": False
+        }
+    }
+}
+
+tools = [feed, play_sound, play_pattern, wait_for_lever, delay, get_human_help, get_reasoning_help, run_trials, get_stats]
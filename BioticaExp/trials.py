@@ -0,0 +1,90 @@
+# trials.py
+import json
+
+
+class TrialRunner:
+
+    LEVERS = {"left": 0, "right": 1}
+    MAX_BLOCK_DURATION = 8*60 # 8 minutes, so a block finishes well inside one run
+    MAX_TRIALS = 100
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def validate(self, protocol: dict) -> str:
+        # Returns an error message, or None if the protocol can run
+        if protocol["rewarded_lever"] not in ("left", "right", "any", "none"):
+            return "rewarded_lever must be one of left, right, any or none"
+        if protocol["tone_duration"] > 0 and not (
+            self.controller.MIN_FREQ <= protocol["tone_frequency"] <= self.controller.MAX_FREQ
+        ):
+            return f"tone_frequency must be between {self.controller.MIN_FREQ} and {self.controller.MAX_FREQ} Hz"
+        if not 1 <= protocol["repeat"] <= self.MAX_TRIALS:
+            return f"repeat must be between 1 and {self.MAX_TRIALS}"
+        if min(protocol["tone_duration"], protocol["response_window"], protocol["reward_duration"], protocol["inter_trial_interval"]) < 0:
+            return "durations cannot be negative"
+        # A reward also takes the feeder's lower and lift travel, a few seconds each time
+        reward = protocol["reward_duration"] + self.controller.feeder.cycle_time() if (
+            protocol["reward_duration"] > 0 and protocol["rewarded_lever"] != "none"
+        ) else 0
+        trial = (
+            max(protocol["tone_duration"], protocol["response_window"])
+            + reward
+            + protocol["inter_trial_interval"]
+        )
+        if trial * protocol["repeat"] > self.MAX_BLOCK_DURATION:
+            return f"the block could take up to {trial * protocol['repeat']:.0f} seconds, the maximum is {self.MAX_BLOCK_DURATION} seconds"
+        return None
+
+    def run(self, protocol: dict) -> str:
+        error = self.validate(protocol)
+        if error:
+            return json.dumps({"error": error})
+
+        # Presses between response windows belong to the block, not to the agent
+        self.controller.begin_wait()
+        try:
+            return json.dumps(self._run(protocol))
+        finally:
+            self.controller.end_wait()
+
+    def _run(self, protocol: dict) -> dict:
+        controller = self.controller
+        presses = [0, 0]
+        latencies = []
+        rewards = 0
+        misses = 0
+        for _ in range(protocol["repeat"]):
+            tone = None
+            onset = controller.clock.monotonic()
+            if protocol["tone_duration"] > 0:
+                tone = controller.start_sound(protocol["tone_duration"], protocol["tone_frequency"])
+            # The response window opens at tone onset
+            press = controller.wait_for_lever(protocol["response_window"])
+            if press >= 0:
+                presses[press] += 1
+                latencies.append(press.monotonic - onset)
+            else:
+                misses += 1
+            if tone:
+                tone.wait()
+            if self._rewarded(protocol["rewarded_lever"], press) and protocol["reward_duration"] > 0:
+                rewards += controller.feed(protocol["reward_duration"])
+            controller.delay(protocol["inter_trial_interval"])
+
+        trials = protocol["repeat"]
+        return {
+            "trials": trials,
+            "left_presses": presses[0],
+            "right_presses": presses[1],
+            "misses": misses,
+            "rewards": rewards,
+            "response_rate": round((trials - misses) / trials, 3),
+            "mean_latency": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "latencies": [round(l, 2) for l in latencies],
+        }
+
+    def _rewarded(self, rewarded_lever: str, press: int) -> bool:
+        if press < 0 or rewarded_lever == "none":
+            return False
+        return rewarded_lever == "any" or self.LEVERS[rewarded_lever] == press
@@ -0,0 +1,8 @@
+# conftest.py
+import os
+import sys
+
+# The modules in BioticaExp import each other by bare name
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "BioticaExp"))
+os.environ.setdefault("BIOTICA_HARDWARE", "sim")
+os.environ.setdefault("BIOTICA_METRICS_PORT", "0")
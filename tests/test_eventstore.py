@@ -0,0 +1,22 @@
+# test_eventstore.py
+from eventstore import Device, EventStore, EventType
+
+
+def test_press_counts_partial_last_window(tmp_path):
+    store = EventStore(str(tmp_path / "events.bin"))
+    start = 1000.0
+    store.append(start + 10, Device.LEFT_LEVER, EventType.PRESS)
+    store.append(start + 50, Device.RIGHT_LEVER, EventType.PRESS)
+    store.append(start + 99, Device.LEFT_LEVER, EventType.PRESS)
+    store.append(start + 99.5, Device.RIGHT_LEVER, EventType.PRESS)
+    counts = store.press_counts(start, start + 100, 40)
+    assert counts == [(start, 1, 0), (start + 40, 0, 1), (start + 80, 1, 1)]
+    store.close()
+
+
+def test_press_counts_whole_windows(tmp_path):
+    store = EventStore(str(tmp_path / "events.bin"))
+    start = 1000.0
+    store.append(start + 30, Device.LEFT_LEVER, EventType.PRESS)
+    assert store.press_counts(start, start + 80, 40) == [(start, 1, 0), (start + 40, 0, 0)]
+    store.close()
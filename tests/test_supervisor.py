@@ -0,0 +1,75 @@
+# test_supervisor.py
+import asyncio
+import logging
+import threading
+
+from supervisor import CageSupervisor
+
+
+class CrashingAgent:
+
+    # train() raises once; the second train() stops the supervisor loop
+
+    def __init__(self, stop, reset_fails=False):
+        self.stop = stop
+        self.reset_fails = reset_fails
+        self.calls = []
+        self.logger = logging.getLogger("test")
+
+    def train(self):
+        self.calls.append("train")
+        if self.calls.count("train") == 1:
+            raise RuntimeError("stream died")
+        self.stop()
+
+    def reset(self):
+        self.calls.append("reset")
+        if self.reset_fails:
+            raise RuntimeError("network down")
+
+
+class AsyncCrashingAgent(CrashingAgent):
+
+    async def start(self):
+        pass
+
+    async def train(self):
+        super().train()
+
+    async def reset(self):
+        super().reset()
+
+
+def _supervisor():
+    supervisor = CageSupervisor.__new__(CageSupervisor)
+    supervisor._stop = threading.Event()
+    supervisor.RESTART_DELAY = 0
+    return supervisor
+
+
+def test_crash_resets_before_restart():
+    supervisor = _supervisor()
+    agent = CrashingAgent(supervisor._stop.set)
+    supervisor._run_cage("cage1", agent)
+    assert agent.calls == ["train", "reset", "train", "reset"]
+
+
+def test_failing_reset_does_not_stop_the_cage():
+    supervisor = _supervisor()
+    agent = CrashingAgent(supervisor._stop.set, reset_fails=True)
+    supervisor._run_cage("cage1", agent)
+    assert agent.calls[:3] == ["train", "reset", "train"]
+
+
+def test_async_crash_resets_before_restart():
+    supervisor = _supervisor()
+    class Stop(BaseException):
+        pass
+    def stop():
+        raise Stop()
+    agent = AsyncCrashingAgent(stop, reset_fails=True)
+    try:
+        asyncio.run(supervisor._run_cage_async("cage1", agent))
+    except Stop:
+        pass
+    assert agent.calls == ["train", "reset", "train"]